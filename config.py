@@ -24,6 +24,58 @@ MAX_TOKENS = 1000
 MODEL_TEMPERATURE = 1
 MODEL_TOP_P = 0.95
 MODEL_N = 1
+LLM_MAX_CONCURRENCY = 8
+SENTENCES_PER_CHUNK = 3
+# "punkt" for the NLTK model, "regex" for the faster rule-based splitter
+SENTENCE_SPLITTER = "punkt"
+CHUNK_MAX_CONCURRENCY = 4
+VALIDATION_DATA_PATH = "kwerty_data.csv"
+VALIDATION_SNAPSHOT_PATH = "kwerty_data.snapshot"
+MEMORY_MAP_VALIDATION_DATA = True
+# Seconds between checks of each worker for a snapshot rewritten by a reload in another worker; 0 disables.
+DATASET_WATCH_INTERVAL = 5
+# Minimum trigram similarity for an indicator to match a metric name it does not contain verbatim
+FUZZY_MATCH_THRESHOLD = 0.6
+FUZZY_MATCH_LIMIT = 5
+# When a claim has no usable month or year, a cell matches it if it is within this many units of
+# the claim's last digit (0.5: "6.2" matches 6.15 to 6.25), searched among the indicator's periods.
+VALUE_ROUNDING_TOLERANCE = 0.5
+# A period found that way is returned with PERIOD_INFERRED and the claim is not valid. With this
+# set, a claim whose value equals (in float32) a cell of the found period counts as valid instead.
+ACCEPT_INFERRED_PERIODS = False
+# Other spellings of dataset countries. All-caps aliases and codes only match in upper case.
+COUNTRY_ALIASES = {
+    "United States": ["US", "U.S.", "USA", "U.S.A.", "United States of America"],
+    "United Kingdom": ["UK", "U.K.", "Britain", "Great Britain"],
+    "Korea": ["South Korea", "Republic of Korea"],
+    "Slovak Republic": ["Slovakia"],
+    "Turkey": ["Türkiye", "Turkiye"],
+    "United Arab Emirates": ["UAE", "U.A.E."],
+    "Russia": ["Russian Federation"],
+    "Netherlands": ["Holland", "The Netherlands"],
+}
+# Phrases that mark a claimed value as a change or an average instead of a level, per derived series
+SERIES_KEYWORDS = {
+    "yoy": [
+        "year-on-year", "year on year", "year-over-year", "year over year", "yoy", "y/y",
+        "from a year earlier", "from a year ago", "annual growth", "annual change",
+    ],
+    "qoq": [
+        "quarter-on-quarter", "quarter on quarter", "quarter-over-quarter", "quarter over quarter", "qoq", "q/q",
+        "from the previous quarter", "quarterly growth", "quarterly change",
+    ],
+    "mom": [
+        "month-on-month", "month on month", "month-over-month", "month over month", "m/m",
+        "from the previous month", "monthly growth", "monthly change",
+    ],
+    "avg3m": ["three-month average", "3-month average", "three-month rolling average", "3-month rolling average"],
+}
+EXTRACTION_CACHE_PATH = "extractions.sqlite3"
+TINYDB_PATH = "db.json"
+# Profiled requests (see `KwertyAPIConfig.profiling_enabled`) are written here, and the slowest
+# functions are listed in the response.
+PROFILE_OUTPUT_PATH = "profiles"
+PROFILE_TOP_FUNCTIONS = 30
 ERROR_REASONS = {
     "CountryNotSupported": "The country in the text is not supported",
     "NoMetricsFound": "No metrics found in extraction",
@@ -475,3 +527,7 @@ class KwertyAPIConfig(BaseSettings):
     openai_top_p: float = 0.95
     openai_model_name: str = "text-davinci-003"
     openai_chat_name: str = "gpt-3.5-turbo"
+    # Token for the admin endpoints (ADMIN_TOKEN); they are disabled when it is not set.
+    admin_token: str = None
+    # Lets a request to /evaluate/ ask to be profiled (PROFILING_ENABLED); off in production.
+    profiling_enabled: bool = False
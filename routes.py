@@ -1,66 +1,116 @@
+import asyncio
+import hmac
+import json
 from pprint import pprint
+from typing import Dict, List, Literal, Optional
 
-import nltk
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Header, HTTPException, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
-from tinydb import Query
-from tinydb.table import Table
 
-from config import STORED_RESPONSES
-from services import STARTUP_OBJECTS
+from config import CHUNK_MAX_CONCURRENCY, MEMORY_MAP_VALIDATION_DATA, STORED_RESPONSES, SENTENCES_PER_CHUNK
+from services import STARTUP_OBJECTS, telemetry
+from services.cache_keys import CACHE_STATS, cache_key
+from services.country_resolver import CountryResolver
+from services.dataset import Dataset, ReloadInProgress, current_dataset, ingest_delta, reload_dataset
+from services.extraction_cache import ExtractionCache
+from services.lookup_engine import LookupEngine
 from services.metrics_manager import MetricsManager
+from services.pandas_query import CountryMetric, PandasQuery
+from services.profiling import ProfilerBusy, RequestProfile
 from services.prompt_manager import KorPromptManager
+from services.sentence_splitter import split_text_into_spans
+from services.snapshot import SnapshotError
+from services.telemetry import stage
 
 router = APIRouter()
 
 
 class UserText(BaseModel):
     text: str
+    splitter: Optional[Literal["punkt", "regex"]] = None
+
+
+class UserTexts(BaseModel):
+    texts: List[str]
+    splitter: Optional[Literal["punkt", "regex"]] = None
+
+
+STORED_RESPONSE_INDEX = {cache_key(text): response for text, response in STORED_RESPONSES.items()}
 
 
 def get_stored(user_text: str):
-    response = STORED_RESPONSES.get(user_text)
+    response = STORED_RESPONSE_INDEX.get(cache_key(user_text))
+    CACHE_STATS.record("stored_responses", hit=response is not None)
     if response:
         return response.get('extracted_information')
     return response
 
 
-def split_text_into_sentences(text_):
-    try:
-        nltk.data.find('tokenizers/punkt')
-    except LookupError:
-        nltk.download('punkt')
+def chunk_sentences(user_text, sentence_spans):
+    """
+    Group the sentence spans into chunks with content-defined boundaries: a chunk ends after a
+    sentence whose cache key falls on a boundary (one sentence in SENTENCES_PER_CHUNK on average),
+    or once it holds twice that many sentences. Inserting or deleting a sentence then only changes
+    the chunk it is in, and the chunks after it keep their text and so their chunk cache entries,
+    where fixed windows counted from the top would all shift.
+    """
+    chunks, current = [], []
+    for start, end in sentence_spans:
+        current.append((start, end))
+        boundary = int(cache_key(user_text[start:end])[:8], 16) % SENTENCES_PER_CHUNK == 0
+        if boundary or len(current) >= 2 * SENTENCES_PER_CHUNK:
+            chunks.append(current)
+            current = []
+    if current:
+        chunks.append(current)
+    return chunks
 
-    ignored_tokens = nltk.word_tokenize(". - +")
-    sentence_tokenizer = nltk.data.load('tokenizers/punkt/english.pickle')
-    sentence_tokenizer._params.abbrev_types.update(ignored_tokens)
 
-    # Split the text into sentences
-    sentences = sentence_tokenizer.tokenize(text_)
+def check_metrics(db: ExtractionCache, user_text: str, get_metrics=False):
+    with stage("cache_lookup"):
+        if not get_metrics:
+            stored = get_stored(user_text)
+            if stored:
+                return stored
+        return db.get(user_text, 'processed_metrics' if get_metrics else 'extracted_information')
 
-    return sentences
 
+def serialize(content):
+    """The JSON response of an endpoint, encoded here so the time it takes is measured."""
+    with stage("serialization"):
+        return JSONResponse(jsonable_encoder(content))
 
-def chunkify(lst, n):
-    """Yield successive n-sized chunks from lst."""
-    for i in range(0, len(lst), n):
-        yield lst[i:i + n]
 
+def align_offsets(extracted_information, user_text, sentence_spans):
+    """
+    A cache hit may come from a text that only canonicalizes to the same key, e.g. with different
+    whitespace, so point each entry at the start and end of its chunk in this text.
+    """
+    chunk_bounds = [
+        (chunk_spans[0][0], chunk_spans[-1][1]) for chunk_spans in chunk_sentences(user_text, sentence_spans)
+    ]
+    aligned = []
+    for country_information in extracted_information:
+        chunk_index = country_information.get("chunk_index")
+        if chunk_index is not None and chunk_index < len(chunk_bounds):
+            start, end = chunk_bounds[chunk_index]
+            country_information = dict(country_information, text_offset=start, text_end=end)
+        aligned.append(country_information)
+    return aligned
 
-def check_metrics(db, user_text: str, get_metrics=False):
-    query = Query()
-    query_result = db.search(query.user_text == user_text)
-    if query_result:
-        return query_result[0].get('processed_metrics') if get_metrics else query_result[0].get('extracted_information')
 
-
-def extract_information(user_text, previous=None):
+async def extract_information(user_text, previous=None):
     prompt_manager = KorPromptManager(user_text=user_text)
-    prompt_result = prompt_manager.run(previous=previous)
+    prompt_result = await prompt_manager.arun(previous=previous)
     data = prompt_result["data"]
     pprint(
         prompt_result
     )
+    if "extracted_information" not in data and not prompt_result.get("errors"):
+        # kor decodes a reply without JSON, or with `{}`, to empty data: the text has no metrics.
+        return []
     if "extracted_information" not in data:
         pprint(data)
         raise HTTPException(
@@ -73,50 +123,340 @@ def extract_information(user_text, previous=None):
     return data['extracted_information']
 
 
-@router.post("/evaluate/")
-async def evaluate_text(user_text: UserText):
-    db: Table = STARTUP_OBJECTS['db']
+def text_chunks(user_text, sentence_spans):
+    """(chunk index, start offset, chunk text) for each chunk of sentences."""
+    chunks = []
+    for chunk_index, chunk_spans in enumerate(chunk_sentences(user_text, sentence_spans)):
+        start, end = chunk_spans[0][0], chunk_spans[-1][1]
+        chunks.append((chunk_index, start, user_text[start:end]))
+    return chunks
+
+
+async def extract_chunk_text(db: ExtractionCache, chunk_text, semaphore: asyncio.Semaphore):
+    with stage("cache_lookup"):
+        chunk_information = db.get_chunk(chunk_text)
+    if chunk_information is None:
+        async with semaphore:
+            chunk_information = await extract_information(chunk_text)
+        db.insert_chunk(chunk_text, chunk_information)
+    return chunk_information
+
+
+async def extract_chunk_texts(db: ExtractionCache, chunk_texts: Dict[str, str]):
+    """
+    Extract chunk texts, keyed by their cache key, concurrently. Chunks already in the chunk cache
+    are not sent to the LLM. A chunk whose extraction failed maps to the exception.
+    """
+    semaphore = asyncio.Semaphore(CHUNK_MAX_CONCURRENCY)
+    keys = list(chunk_texts)
+    results = await asyncio.gather(
+        *(extract_chunk_text(db, chunk_texts[key], semaphore) for key in keys), return_exceptions=True
+    )
+    return dict(zip(keys, results))
+
+
+def assemble_chunks(chunks, chunk_results):
+    """
+    Merge the chunk extractions of a text in document order. Each country entry records the
+    chunk it was extracted from and that chunk's start and end offsets.
+    """
+    extracted_information = []
+    for chunk_index, start, chunk_text in chunks:
+        chunk_information = chunk_results[cache_key(chunk_text)]
+        if isinstance(chunk_information, Exception):
+            raise chunk_information
+        extracted_information.extend(
+            dict(country_information, text_offset=start, text_end=start + len(chunk_text), chunk_index=chunk_index)
+            for country_information in chunk_information
+        )
+    return extracted_information
+
+
+async def extract_chunks(db: ExtractionCache, user_text, sentence_spans):
+    """
+    Extract every chunk of sentences concurrently, so resubmitting an edited text only extracts
+    the chunks that changed.
+    """
+    chunks = text_chunks(user_text, sentence_spans)
+    chunk_results = await extract_chunk_texts(
+        db, {cache_key(chunk_text): chunk_text for _, _, chunk_text in chunks}
+    )
+    return assemble_chunks(chunks, chunk_results)
+
+
+def resolve_rows(extracted_informations, dataset: Dataset):
+    """
+    Resolve the dataset rows of every metric of many texts in one pass grouped by country, so
+    texts that check the same indicator share one lookup.
+    """
+    lookup_engine: LookupEngine = dataset.lookup_engine
+    country_resolver: CountryResolver = dataset.country_resolver
+    queries = set()
+    for extracted_information in extracted_informations:
+        for country_information in extracted_information:
+            country_name = country_resolver.canonical(country_information.get("country"))
+            for metric in country_information.get("country_metrics") or []:
+                try:
+                    queries.add(PandasQuery.lookup_query(country_name, CountryMetric(**metric)))
+                except ValueError:
+                    continue
+    return lookup_engine.resolve_many(queries)
+
+
+async def evaluate(user_text: UserText):
+    db: ExtractionCache = STARTUP_OBJECTS['db']
+    dataset = current_dataset()
+    splitter = user_text.splitter
     user_text = user_text.text
-    sentence_count = split_text_into_sentences(user_text)
     extracted_information = []
-    chunks = list(chunkify(sentence_count, 3))[0]
-    sliced_chunk = chunks[:3]
-    chunk_combined = " ".join(sliced_chunk)
+    sentence_spans = split_text_into_spans(user_text, splitter)
     maybe_metrics = check_metrics(db, user_text)
     if maybe_metrics:
-        extracted_information.extend(maybe_metrics)
+        extracted_information.extend(align_offsets(maybe_metrics, user_text, sentence_spans))
     else:
-        chunk_information = extract_information(chunk_combined)
-        extracted_information.extend(chunk_information)
-        db.insert(
-            {
-                "user_text": user_text,
-                "extracted_information": extracted_information
-            }
-        )
-    # for chunk in chunks:
-    #     chunk_combined = " ".join(chunk)
-    #     maybe_metrics = check_metrics(db, chunk_combined)
-    #     if maybe_metrics:
-    #         extracted_information.extend(maybe_metrics)
-    #     else:
-    #         print(chunk_combined)
-    #         chunk_information = extract_information(chunk_combined, previous=previous)
-    #         previous = {
-    #             "text": user_text,
-    #             "metrics": chunk_information
-    #         }
-    #         pprint(chunk_information)
-    #         extracted_information.extend(chunk_information)
-    #         db.insert(
-    #             {
-    #                 "user_text": user_text,
-    #                 "extracted_information": extracted_information
-    #             }
-    #         )
-    metrics = MetricsManager(user_text=user_text, country_data=extracted_information)
+        extracted_information.extend(await extract_chunks(db, user_text, sentence_spans))
+        db.insert(user_text, extracted_information)
+    metrics = MetricsManager(user_text=user_text, country_data=extracted_information, dataset=dataset)
     processed_metrics = metrics.process_metrics()
     # pprint(
     #     processed_metrics
     # )
     return processed_metrics
+
+
+@router.post("/evaluate/")
+async def evaluate_text(user_text: UserText, profile: bool = False, x_kwerty_profile: bool = Header(False)):
+    """
+    With `?profile=true` or an `X-Kwerty-Profile: true` header, and `profiling_enabled` in the
+    config, the call runs under the profiler and the response gets a `profile` entry with the
+    span tree and the slowest functions (see `services.profiling`). Otherwise the flag is ignored.
+    """
+    if not ((profile or x_kwerty_profile) and STARTUP_OBJECTS["config"].profiling_enabled):
+        return serialize(await evaluate(user_text))
+    try:
+        with RequestProfile("evaluate_text", characters=len(user_text.text)) as request_profile:
+            processed_metrics = await evaluate(user_text)
+            with stage("serialization"):
+                content = jsonable_encoder(processed_metrics)
+    except ProfilerBusy as error:
+        raise HTTPException(status_code=409, detail={"message": str(error)})
+    content["profile"] = request_profile.save()
+    return JSONResponse(content)
+
+
+@router.post("/evaluate/batch")
+async def evaluate_batch(user_texts: UserTexts):
+    """
+    Evaluate many texts at once. Identical texts and chunks are only processed once, uncached
+    chunks of all texts are extracted concurrently and dataset rows are resolved in one pass.
+    Results come back in input order, each with its own error instead of failing the batch.
+    """
+    db: ExtractionCache = STARTUP_OBJECTS['db']
+    dataset = current_dataset()
+    unique_texts = list(dict.fromkeys(user_texts.texts))
+    extracted, errors, results = {}, {}, {}
+    pending_texts = {}
+    pending_chunks = {}
+    for user_text in unique_texts:
+        sentence_spans = split_text_into_spans(user_text, user_texts.splitter)
+        maybe_metrics = check_metrics(db, user_text)
+        if maybe_metrics:
+            extracted[user_text] = align_offsets(maybe_metrics, user_text, sentence_spans)
+        else:
+            pending_texts[user_text] = text_chunks(user_text, sentence_spans)
+            for _, _, chunk_text in pending_texts[user_text]:
+                pending_chunks.setdefault(cache_key(chunk_text), chunk_text)
+
+    chunk_results = await extract_chunk_texts(db, pending_chunks)
+    for user_text, chunks in pending_texts.items():
+        try:
+            extracted[user_text] = assemble_chunks(chunks, chunk_results)
+            db.insert(user_text, extracted[user_text])
+        except HTTPException as error:
+            errors[user_text] = error.detail
+
+    resolved_rows = resolve_rows(extracted.values(), dataset)
+    for user_text, extracted_information in extracted.items():
+        try:
+            metrics = MetricsManager(
+                user_text=user_text, country_data=extracted_information, resolved_rows=resolved_rows, dataset=dataset
+            )
+            results[user_text] = metrics.process_metrics()
+        except HTTPException as error:
+            errors[user_text] = error.detail
+        except ValueError as error:
+            errors[user_text] = {"message": "The extracted metrics could not be validated", "details": str(error)}
+
+    return serialize({
+        "results": [
+            {
+                "index": index,
+                "result": results.get(user_text),
+                "error": errors.get(user_text),
+            }
+            for index, user_text in enumerate(user_texts.texts)
+        ]
+    })
+
+
+def match_events(user_text, extracted_information, dataset: Dataset):
+    try:
+        result = MetricsManager(
+            user_text=user_text, country_data=extracted_information, dataset=dataset
+        ).process_metrics()
+    except HTTPException as error:
+        return [{"event": "error", "error": error.detail}]
+    events = [{"event": "match", "match": match} for match in result.metric_match.matches]
+    if result.error:
+        events.append({"event": "error", "error": result.error})
+    return events
+
+
+@router.post("/evaluate/stream")
+async def evaluate_stream(user_text: UserText, request: Request):
+    """
+    Streaming variant of `/evaluate/`: every match is sent as soon as the chunk it belongs to has
+    been extracted and validated, as NDJSON or, with `Accept: text/event-stream`, as server-sent
+    events. The stream ends with a `done` event.
+    """
+    db: ExtractionCache = STARTUP_OBJECTS['db']
+    splitter = user_text.splitter
+    user_text = user_text.text
+    event_stream = "text/event-stream" in request.headers.get("accept", "")
+
+    def encode(event):
+        with stage("serialization"):
+            line = json.dumps(jsonable_encoder(event))
+        return f"data: {line}\n\n" if event_stream else f"{line}\n"
+
+    async def extract(chunk, semaphore):
+        try:
+            return chunk, await extract_chunk_text(db, chunk[2], semaphore)
+        except HTTPException as error:
+            return chunk, error
+
+    async def events():
+        dataset = current_dataset()
+        sentence_spans = split_text_into_spans(user_text, splitter)
+        maybe_metrics = check_metrics(db, user_text)
+        if maybe_metrics:
+            for event in match_events(user_text, align_offsets(maybe_metrics, user_text, sentence_spans), dataset):
+                yield encode(event)
+        else:
+            chunks = text_chunks(user_text, sentence_spans)
+            semaphore = asyncio.Semaphore(CHUNK_MAX_CONCURRENCY)
+            extracted = {}
+            tasks = [asyncio.create_task(extract(chunk, semaphore)) for chunk in chunks]
+            try:
+                for next_chunk in asyncio.as_completed(tasks):
+                    chunk, chunk_information = await next_chunk
+                    if isinstance(chunk_information, HTTPException):
+                        yield encode({"event": "error", "chunk_index": chunk[0], "error": chunk_information.detail})
+                        continue
+                    extracted[chunk[0]] = assemble_chunks([chunk], {cache_key(chunk[2]): chunk_information})
+                    for event in match_events(user_text, extracted[chunk[0]], dataset):
+                        yield encode(event)
+            finally:
+                # When the client disconnects the generator is closed here; stop the LLM calls still running.
+                for task in tasks:
+                    task.cancel()
+            if len(extracted) == len(chunks):
+                db.insert(user_text, [entry for index in sorted(extracted) for entry in extracted[index]])
+        yield encode({"event": "done", "dataset_version": dataset.version})
+
+    return StreamingResponse(
+        events(), media_type="text/event-stream" if event_stream else "application/x-ndjson"
+    )
+
+
+@router.get("/ready/")
+async def ready():
+    dataset = STARTUP_OBJECTS.get("dataset")
+    validation_data = dataset.validation_data if dataset else None
+    if validation_data is None or (MEMORY_MAP_VALIDATION_DATA and not validation_data.memory_mapped):
+        raise HTTPException(
+            status_code=503,
+            detail={
+                "message": "The validation data is not loaded yet",
+                "ready": False,
+            },
+        )
+    return {
+        "ready": True,
+        "memory_mapped": validation_data.memory_mapped,
+        "dataset_version": validation_data.version,
+    }
+
+
+@router.get("/cache/stats/")
+async def cache_stats():
+    return CACHE_STATS.snapshot()
+
+
+@router.get("/metrics/")
+async def metrics():
+    """Stage latencies, LLM token usage, cache hits and validation outcomes in the Prometheus text format."""
+    return PlainTextResponse(telemetry.render(), media_type=telemetry.CONTENT_TYPE)
+
+
+@router.post("/admin/reload/")
+async def reload_validation_data(x_admin_token: Optional[str] = Header(None)):
+    """
+    Load a new release of the validation data without a restart. It is loaded and indexed in a
+    worker thread while requests keep being served from the current one, then swapped in. Other
+    worker processes swap in the rebuilt snapshot within DATASET_WATCH_INTERVAL seconds, so
+    until then responses may carry either `dataset_version`.
+    """
+    admin_token = STARTUP_OBJECTS["config"].admin_token
+    if not admin_token:
+        raise HTTPException(status_code=404, detail={"message": "Admin endpoints are disabled"})
+    if not x_admin_token or not hmac.compare_digest(x_admin_token, admin_token):
+        raise HTTPException(status_code=403, detail={"message": "Invalid admin token"})
+
+    previous_version = current_dataset().version
+    try:
+        dataset = await asyncio.to_thread(reload_dataset)
+    except ReloadInProgress as error:
+        raise HTTPException(status_code=409, detail={"message": str(error)})
+    except (SnapshotError, OSError, ValueError) as error:
+        raise HTTPException(
+            status_code=500,
+            detail={"message": "The validation data could not be reloaded", "details": str(error)},
+        )
+    return {"previous_version": previous_version, "dataset_version": dataset.version}
+
+
+@router.post("/admin/ingest/")
+async def ingest_validation_delta(request: Request, x_admin_token: Optional[str] = Header(None)):
+    """
+    Merge a monthly release into the validation data without a reload. The body is a CSV in the
+    layout of the validation data holding only the new period columns and the changed or new rows.
+    The merged data is written to the snapshot, which the other workers swap in within
+    DATASET_WATCH_INTERVAL seconds.
+    """
+    admin_token = STARTUP_OBJECTS["config"].admin_token
+    if not admin_token:
+        raise HTTPException(status_code=404, detail={"message": "Admin endpoints are disabled"})
+    if not x_admin_token or not hmac.compare_digest(x_admin_token, admin_token):
+        raise HTTPException(status_code=403, detail={"message": "Invalid admin token"})
+
+    previous = current_dataset()
+    try:
+        dataset = await asyncio.to_thread(ingest_delta, await request.body())
+    except ReloadInProgress as error:
+        raise HTTPException(status_code=409, detail={"message": str(error)})
+    except ValueError as error:
+        raise HTTPException(
+            status_code=400, detail={"message": "The delta could not be merged", "details": str(error)}
+        )
+    except (SnapshotError, OSError) as error:
+        raise HTTPException(
+            status_code=500,
+            detail={"message": "The merged validation data could not be written", "details": str(error)},
+        )
+    return {
+        "previous_version": previous.version,
+        "dataset_version": dataset.version,
+        "rows_added": dataset.validation_data.row_count - previous.validation_data.row_count,
+        "periods_added": len(dataset.validation_data.periods) - len(previous.validation_data.periods),
+    }
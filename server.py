@@ -1,16 +1,29 @@
+import asyncio
 import logging
 import os
 import sys
 from contextlib import asynccontextmanager
 
-import pandas
 import uvicorn
 from fastapi import FastAPI
 from starlette.middleware.cors import CORSMiddleware
-from tinydb import TinyDB
-from config import KwertyAPIConfig
+from config import (
+    DATASET_WATCH_INTERVAL,
+    EXTRACTION_CACHE_PATH,
+    MAX_TOKENS,
+    TINYDB_PATH,
+    VALIDATION_DATA_PATH,
+    VALIDATION_SNAPSHOT_PATH,
+    KwertyAPIConfig,
+)
 from routes import router
 from services import STARTUP_OBJECTS
+from services.dataset import Dataset, watch_snapshot
+from services.extraction_cache import ExtractionCache
+from services.prompt_manager import KorPromptManager
+from services.sentence_splitter import load_sentence_tokenizer
+from services.snapshot import load_dataset
+from services.telemetry import RequestTimer
 
 logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
 logging.getLogger().addHandler(logging.StreamHandler(stream=sys.stdout))
@@ -19,20 +32,33 @@ config = KwertyAPIConfig()
 
 
 def load_validation_data():
-    return pandas.read_csv("kwerty_data.csv", encoding='utf-8', engine='python')
+    return load_dataset(VALIDATION_DATA_PATH, VALIDATION_SNAPSHOT_PATH)
 
 
-def load_tiny():
-    db = TinyDB('db.json')
-    return db
+def load_cache():
+    cache = ExtractionCache(EXTRACTION_CACHE_PATH)
+    cache.migrate_tinydb(TINYDB_PATH)
+    return cache
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    STARTUP_OBJECTS["validation_data"] = load_validation_data()
-    STARTUP_OBJECTS["db"] = load_tiny()
+    STARTUP_OBJECTS["config"] = config
+    STARTUP_OBJECTS["dataset"] = Dataset.build(load_validation_data())
+    logging.info(
+        "Loaded validation data %s (memory mapped: %s)",
+        STARTUP_OBJECTS["dataset"].version,
+        STARTUP_OBJECTS["dataset"].validation_data.memory_mapped,
+    )
+    STARTUP_OBJECTS["db"] = load_cache()
+    KorPromptManager.get_chain(MAX_TOKENS)
+    load_sentence_tokenizer()
+    watcher = asyncio.create_task(watch_snapshot()) if DATASET_WATCH_INTERVAL else None
 
     yield
+    if watcher:
+        watcher.cancel()
+    STARTUP_OBJECTS["db"].close()
     STARTUP_OBJECTS.clear()
 
 
@@ -50,6 +76,7 @@ def load_app():
         allow_credentials=True,
         allow_headers=["*"],
     )
+    app.add_middleware(RequestTimer)
     app.include_router(router, prefix="/kwerty")
     return app
 
@@ -0,0 +1,55 @@
+import hashlib
+import re
+import threading
+import unicodedata
+from collections import defaultdict
+
+# Bump when `canonicalize` changes so persisted cache keys are recomputed.
+CACHE_KEY_VERSION = "1"
+
+CHARACTER_REPLACEMENTS = str.maketrans(
+    {
+        "‘": "'", "’": "'", "‚": "'", "‛": "'", "′": "'", "`": "'",
+        "“": '"', "”": '"', "„": '"', "‟": '"', "″": '"',
+        "‐": "-", "‑": "-", "‒": "-", "–": "-", "—": "-", "―": "-", "−": "-",
+    }
+)
+SPACE_BEFORE_PUNCTUATION = re.compile(r"\s+([.,;:!?])")
+TRAILING_PUNCTUATION = " .,;:!?"
+
+
+def canonicalize(text: str) -> str:
+    """
+    Canonical form of a text for cache lookups: Unicode compatibility forms folded, curly quotes
+    and dashes made plain, whitespace collapsed and trailing punctuation dropped. Texts that only
+    differ in those ways get the same extraction, so they should share a cache entry.
+    """
+    text = unicodedata.normalize("NFKC", text).translate(CHARACTER_REPLACEMENTS)
+    text = SPACE_BEFORE_PUNCTUATION.sub(r"\1", " ".join(text.split()))
+    return text.rstrip(TRAILING_PUNCTUATION)
+
+
+def cache_key(text: str) -> str:
+    return hashlib.sha256(canonicalize(text).encode("utf-8")).hexdigest()
+
+
+class CacheStats:
+    """Hit/miss counters per cache layer, for this worker process."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = defaultdict(lambda: {"hits": 0, "misses": 0})
+
+    def record(self, layer: str, hit: bool):
+        with self.lock:
+            self.counts[layer]["hits" if hit else "misses"] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                layer: dict(counts, hit_rate=counts["hits"] / ((counts["hits"] + counts["misses"]) or 1))
+                for layer, counts in self.counts.items()
+            }
+
+
+CACHE_STATS = CacheStats()
@@ -0,0 +1,133 @@
+import dataclasses
+from collections import defaultdict, deque
+from typing import Dict, List, Optional, Tuple
+
+from config import COUNTRY_ALIASES
+from services.validation_store import ValidationStore
+
+
+@dataclasses.dataclass
+class CountryMention:
+    country: str
+    start: int
+    end: int
+
+
+def is_case_sensitive(pattern: str) -> bool:
+    """Codes and abbreviations like "BEL" or "U.S." only match in upper case, so "us" or "can" never do."""
+    letters = [character for character in pattern if character.isalpha()]
+    return bool(letters) and all(character.isupper() for character in letters) and len(letters) <= 4
+
+
+class CountryResolver:
+    """
+    Aho-Corasick automaton over the country names, aliases and codes of the validation data.
+    Built once at startup; finding every country mentioned in a text is a single pass over it.
+    """
+
+    def __init__(self, patterns: Dict[str, str]):
+        self.countries = frozenset(patterns.values())
+        self.exact = {}
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail = [0]
+        self.outputs: List[List[Tuple[int, str, Optional[str]]]] = [[]]
+        for pattern, country in patterns.items():
+            self.exact[pattern if is_case_sensitive(pattern) else pattern.casefold()] = country
+            self._add(pattern, country)
+        self._link()
+
+    @classmethod
+    def from_store(cls, validation_data: ValidationStore, aliases: Dict[str, List[str]] = COUNTRY_ALIASES):
+        names = {name.strip() for name in validation_data.column("country").to_list() if isinstance(name, str)}
+        names.discard("")
+        codes = defaultdict(set)
+        for name, code in zip(
+                validation_data.column("country").to_list(), validation_data.column("country_code").to_list()
+        ):
+            if isinstance(name, str) and isinstance(code, str) and code.strip():
+                codes[code.strip()].add(name.strip())
+
+        patterns = {}
+        # Codes shared by several countries are left out rather than guessed.
+        patterns.update({code: next(iter(owners)) for code, owners in codes.items() if len(owners) == 1})
+        patterns.update(
+            {alias: country for country, country_aliases in aliases.items() if country in names for alias in country_aliases}
+        )
+        patterns.update({name: name for name in names})
+        return cls(patterns)
+
+    def _add(self, pattern: str, country: str):
+        state = 0
+        for character in pattern:
+            key = character.lower()
+            if key not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.outputs.append([])
+                self.goto[state][key] = len(self.goto) - 1
+            state = self.goto[state][key]
+        # Case-sensitive patterns keep their spelling to be checked against the matched text.
+        self.outputs[state].append((len(pattern), country, pattern if is_case_sensitive(pattern) else None))
+
+    def _link(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for key, child in self.goto[state].items():
+                queue.append(child)
+                self.fail[child] = self._step(self.fail[state], key) if state else 0
+                self.outputs[child] = self.outputs[child] + self.outputs[self.fail[child]]
+
+    def _step(self, state: int, key: str) -> int:
+        while state and key not in self.goto[state]:
+            state = self.fail[state]
+        return self.goto[state].get(key, 0)
+
+    def mentions(self, text: str) -> List[CountryMention]:
+        """Non-overlapping, whole-word country mentions in text order, the longest one winning."""
+        found = []
+        state = 0
+        for index, character in enumerate(text):
+            # Lower-casing per character keeps indexes aligned with the original text.
+            state = self._step(state, character.lower())
+            for length, country, spelling in self.outputs[state]:
+                start, end = index + 1 - length, index + 1
+                if spelling is not None and text[start:end] != spelling:
+                    continue
+                if self.is_word(text, start, end):
+                    found.append(CountryMention(country=country, start=start, end=end))
+
+        mentions = []
+        for mention in sorted(found, key=lambda mention: (mention.start, mention.start - mention.end)):
+            if not mentions or mention.start >= mentions[-1].end:
+                mentions.append(mention)
+        return mentions
+
+    @staticmethod
+    def is_word(text: str, start: int, end: int) -> bool:
+        return (start == 0 or not text[start - 1].isalnum()) and (end == len(text) or not text[end].isalnum())
+
+    def lookup(self, name: str) -> Optional[str]:
+        return self.exact.get(name) or self.exact.get(name.casefold())
+
+    def canonical(self, name: Optional[str]) -> Optional[str]:
+        """
+        Dataset spelling of a country name returned by the LLM ("UK", "the United States", ...).
+        Only whole names, aliases and codes match: a name that merely contains a country, like
+        "North Korea" or "Northern Ireland", is returned as is and so is not supported.
+        """
+        if not name:
+            return None
+        name = name.strip()
+        country = self.lookup(name)
+        if not country and name[:4].casefold() == "the ":
+            country = self.lookup(name[4:].lstrip())
+        return country or name
+
+    def guess(self, text: str, text_offset: int = 0) -> Optional[str]:
+        """First country mentioned from `text_offset` on, else the first one in the text."""
+        mentions = self.mentions(text)
+        for mention in mentions:
+            if mention.start >= text_offset:
+                return mention.country
+        return mentions[0].country if mentions else None
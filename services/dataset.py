@@ -0,0 +1,183 @@
+import asyncio
+import dataclasses
+import hashlib
+import io
+import logging
+import os
+import threading
+
+from config import DATASET_WATCH_INTERVAL, MEMORY_MAP_VALIDATION_DATA, VALIDATION_DATA_PATH, VALIDATION_SNAPSHOT_PATH
+from services import STARTUP_OBJECTS
+from services.country_resolver import CountryResolver
+from services.lookup_engine import LookupEngine
+from services.snapshot import (
+    SnapshotError,
+    header_version,
+    load_dataset,
+    load_snapshot,
+    read_snapshot_header,
+    read_validation_csv,
+    write_snapshot,
+)
+from services.validation_store import ValidationStore
+
+RELOAD_LOCK = threading.Lock()
+
+
+class ReloadInProgress(Exception):
+    pass
+
+
+@dataclasses.dataclass(frozen=True)
+class Dataset:
+    """A validation store and the indexes built over it, swapped in as one unit on reload."""
+
+    validation_data: ValidationStore
+    lookup_engine: LookupEngine
+    country_resolver: CountryResolver
+
+    @property
+    def version(self) -> str:
+        return self.validation_data.version
+
+    @classmethod
+    def build(cls, validation_data: ValidationStore):
+        # Mapped from the snapshot, or built up front so the first claim without a usable period
+        # does not pay for it.
+        validation_data.value_index
+        return cls(
+            validation_data=validation_data,
+            lookup_engine=LookupEngine(validation_data),
+            country_resolver=CountryResolver.from_store(validation_data),
+        )
+
+    def with_delta(self, frame, version: str = None) -> "Dataset":
+        """
+        The dataset with a delta release merged in (see `ValidationStore.with_delta`). The lookup
+        indexes only index the appended rows instead of being rebuilt; the country resolver is only
+        rebuilt when the delta brings a country or country code it does not know.
+        """
+        validation_data = self.validation_data.with_delta(frame)
+        validation_data.version = version or self.version
+        # Codes of existing categories do not change when rows are appended.
+        pairs = list(zip(
+            validation_data.column("country").codes.tolist(), validation_data.column("country_code").codes.tolist()
+        ))
+        first_row = self.validation_data.row_count
+        known, added = set(pairs[:first_row]), set(pairs[first_row:])
+        return Dataset(
+            validation_data=validation_data,
+            lookup_engine=self.lookup_engine.with_rows(validation_data),
+            country_resolver=(
+                CountryResolver.from_store(validation_data) if added - known else self.country_resolver
+            ),
+        )
+
+
+def current_dataset() -> Dataset:
+    """The dataset to validate against. Take it once per request, so a reload never mixes versions."""
+    return STARTUP_OBJECTS["dataset"]
+
+
+def reload_dataset(source: str = VALIDATION_DATA_PATH, output: str = VALIDATION_SNAPSHOT_PATH) -> Dataset:
+    """
+    Load the dataset again, rebuilding the snapshot if the CSV changed, and build its indexes while
+    the current dataset keeps serving requests. The new one is then swapped in with a single
+    assignment; requests already running keep the dataset they started with, and the old one is
+    freed as soon as they finish. This only swaps the dataset of the calling worker; the others
+    pick up the rebuilt snapshot through `watch_snapshot`.
+    """
+    if not RELOAD_LOCK.acquire(blocking=False):
+        raise ReloadInProgress("A dataset reload is already running")
+    try:
+        dataset = Dataset.build(load_dataset(source, output))
+        STARTUP_OBJECTS["dataset"] = dataset
+        logging.info("Swapped in validation data %s", dataset.version)
+        return dataset
+    finally:
+        RELOAD_LOCK.release()
+
+
+def ingest_delta(content: bytes, output: str = None) -> Dataset:
+    """
+    Merge a delta release (a CSV in the layout of the validation data) into the current dataset
+    and swap the result in. The merge takes milliseconds, where a reload re-reads the whole CSV.
+
+    The merged store is written as the snapshot (where the current one was loaded from, unless
+    `output` is given) and mapped back, so it is shared through the page cache like a loaded one.
+    Only this worker reuses the incrementally merged lookup indexes and country resolver; the
+    others swap the snapshot in through `watch_snapshot`, which builds them from scratch (see
+    `swap_in_snapshot`). The snapshot keeps the checksum of the CSV it was built from, so restarts
+    keep the delta until the CSV changes; the new CSV must then carry the release too.
+    """
+    if not RELOAD_LOCK.acquire(blocking=False):
+        raise ReloadInProgress("A dataset reload is already running")
+    try:
+        previous = current_dataset()
+        output = output or previous.validation_data.snapshot_path or VALIDATION_SNAPSHOT_PATH
+        version = hashlib.sha256(f"{previous.version}+".encode() + content).hexdigest()
+        merged = previous.with_delta(read_validation_csv(io.BytesIO(content)), version=version)
+        write_snapshot(merged.validation_data, output, merged.validation_data.source_checksum)
+        validation_data = load_snapshot(output, memory_map=MEMORY_MAP_VALIDATION_DATA)
+        # The lookup indexes keep no reference to the store they were built from.
+        dataset = dataclasses.replace(merged, validation_data=validation_data)
+        STARTUP_OBJECTS["dataset"] = dataset
+        logging.info(
+            "Merged a delta into validation data %s: %d rows, %d periods",
+            dataset.version, dataset.validation_data.row_count, len(dataset.validation_data.periods),
+        )
+        return dataset
+    finally:
+        RELOAD_LOCK.release()
+
+
+def swap_in_snapshot(output: str = VALIDATION_SNAPSHOT_PATH):
+    """
+    Swap in the snapshot as it is on disk if it holds another version than the current dataset,
+    without looking at the CSV. Returns the new dataset, or None when the version is the same.
+
+    The cells, series and value index are mapped from the snapshot, but the lookup indexes and the
+    country resolver are rebuilt, in every worker that swaps the snapshot in. That takes time
+    proportional to the row count (about 160 ms for 1,500 rows), in a thread next to the requests
+    this worker keeps serving with the current dataset.
+    """
+    if not RELOAD_LOCK.acquire(blocking=False):
+        raise ReloadInProgress("A dataset reload is already running")
+    try:
+        if header_version(read_snapshot_header(output)) == current_dataset().version:
+            return None
+        dataset = Dataset.build(load_snapshot(output, memory_map=MEMORY_MAP_VALIDATION_DATA))
+        STARTUP_OBJECTS["dataset"] = dataset
+        logging.info("Swapped in validation data %s from %s", dataset.version, output)
+        return dataset
+    finally:
+        RELOAD_LOCK.release()
+
+
+async def watch_snapshot(interval: float = DATASET_WATCH_INTERVAL):
+    """
+    Keep this worker on the version of the snapshot file. Under gunicorn a reload only reaches the
+    worker that handles it; that worker rewrites the snapshot, and every other worker sees the file
+    replaced (it is renamed into place, so its inode and mtime change) and swaps in the new version
+    within `interval` seconds. Run as a task for the lifetime of the worker.
+
+    The file watched is the one the current dataset was loaded from, which is in the temp directory
+    when the configured path is read-only (see `load_dataset`). A store served from memory has none.
+    """
+    seen = None
+    while True:
+        await asyncio.sleep(interval)
+        output = current_dataset().validation_data.snapshot_path
+        if output is None:
+            continue
+        try:
+            status = os.stat(output)
+            identity = (status.st_ino, status.st_mtime_ns, status.st_size)
+            if identity != seen:
+                await asyncio.to_thread(swap_in_snapshot, output)
+                seen = identity
+        except ReloadInProgress:
+            # Looked at again on the next tick, once the running reload is done.
+            continue
+        except (SnapshotError, OSError, ValueError) as error:
+            logging.warning("Could not swap in %s: %s", output, error)
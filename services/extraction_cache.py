@@ -0,0 +1,145 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+from typing import Dict, List, Optional
+
+from config import EXTRACTION_CACHE_PATH, TINYDB_PATH
+from services.cache_keys import CACHE_KEY_VERSION, CACHE_STATS, cache_key
+
+CACHED_FIELDS = ("extracted_information", "processed_metrics")
+
+
+class ExtractionCache:
+    """
+    Extraction results keyed by a hash of the canonicalized text, stored in SQLite in WAL mode.
+    Lookups are a primary key probe and writes append to the WAL instead of rewriting the whole
+    file, and worker processes can share the same database.
+    """
+
+    def __init__(self, path: str = EXTRACTION_CACHE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS extractions ("
+            "key TEXT PRIMARY KEY, user_text TEXT NOT NULL, "
+            "extracted_information TEXT, processed_metrics TEXT)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS chunk_extractions ("
+            "key TEXT PRIMARY KEY, chunk_text TEXT NOT NULL, extracted_information TEXT NOT NULL)"
+        )
+        self.connection.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+        if self.get_meta("key_version") != CACHE_KEY_VERSION:
+            self.rekey()
+
+    @staticmethod
+    def key(user_text: str) -> str:
+        return cache_key(user_text)
+
+    def rekey(self):
+        """Recompute every stored key after the canonicalization has changed."""
+        with self.lock:
+            self.connection.execute("BEGIN")
+            for table, text_column in (("extractions", "user_text"), ("chunk_extractions", "chunk_text")):
+                rows = self.connection.execute(f"SELECT rowid, {text_column} FROM {table}").fetchall()
+                self.connection.execute(f"UPDATE {table} SET key = 'rekey:' || rowid")
+                for rowid, text in rows:
+                    # Texts that now canonicalize to the same key collapse into the first entry.
+                    self.connection.execute(
+                        f"UPDATE OR IGNORE {table} SET key = ? WHERE rowid = ?", (self.key(text), rowid)
+                    )
+                self.connection.execute(f"DELETE FROM {table} WHERE key LIKE 'rekey:%'")
+            self.connection.execute(
+                "INSERT OR REPLACE INTO meta (name, value) VALUES ('key_version', ?)", (CACHE_KEY_VERSION,)
+            )
+            self.connection.execute("COMMIT")
+
+    def get(self, user_text: str, field: str = "extracted_information"):
+        if field not in CACHED_FIELDS:
+            raise ValueError(f"Unknown cache field {field}")
+        with self.lock:
+            row = self.connection.execute(
+                f"SELECT {field} FROM extractions WHERE key = ?", (self.key(user_text),)
+            ).fetchone()
+        CACHE_STATS.record("extractions", hit=bool(row and row[0] is not None))
+        if row and row[0] is not None:
+            return json.loads(row[0])
+
+    def insert(self, user_text: str, extracted_information: List[Dict], processed_metrics: Optional[Dict] = None):
+        self._insert_many([(user_text, extracted_information, processed_metrics)], replace=True)
+
+    def _insert_many(self, entries, replace=False):
+        rows = [
+            (
+                self.key(user_text),
+                user_text,
+                json.dumps(extracted_information),
+                json.dumps(processed_metrics) if processed_metrics is not None else None,
+            )
+            for user_text, extracted_information, processed_metrics in entries
+        ]
+        verb = "INSERT OR REPLACE" if replace else "INSERT OR IGNORE"
+        with self.lock:
+            self.connection.execute("BEGIN")
+            self.connection.executemany(
+                f"{verb} INTO extractions (key, user_text, extracted_information, processed_metrics) "
+                f"VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            self.connection.execute("COMMIT")
+
+    def get_chunk(self, chunk_text: str) -> Optional[List[Dict]]:
+        """Extraction of a single sentence chunk, so unchanged chunks of an edited text are reused."""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT extracted_information FROM chunk_extractions WHERE key = ?",
+                (self.key(chunk_text),),
+            ).fetchone()
+        CACHE_STATS.record("chunks", hit=row is not None)
+        if row:
+            return json.loads(row[0])
+
+    def insert_chunk(self, chunk_text: str, extracted_information: List[Dict]):
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO chunk_extractions (key, chunk_text, extracted_information) VALUES (?, ?, ?)",
+                (self.key(chunk_text), chunk_text, json.dumps(extracted_information)),
+            )
+
+    def get_meta(self, name: str) -> Optional[str]:
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, name: str, value: str):
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", (name, value))
+
+    def migrate_tinydb(self, path: str = TINYDB_PATH) -> int:
+        """One-time import of the documents of the old TinyDB `db.json` cache."""
+        marker = f"migrated:{os.path.abspath(path)}"
+        if not os.path.exists(path) or self.get_meta(marker):
+            return 0
+        with open(path, encoding="utf-8") as tiny_file:
+            content = tiny_file.read().strip()
+        tables = json.loads(content) if content else {}
+        entries = [
+            (document["user_text"], document.get("extracted_information"), document.get("processed_metrics"))
+            for table in tables.values()
+            for document in table.values()
+            if document.get("user_text")
+        ]
+        if entries:
+            self._insert_many(entries)
+        self.set_meta(marker, str(len(entries)))
+        logging.info("Migrated %s cached extractions from %s", len(entries), path)
+        return len(entries)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -1,6 +1,9 @@
 from kor import create_extraction_chain, Object, Text, Number, from_pydantic
+from kor.encoders.encode import encode_examples, format_text
+from kor.prompts import ExtractionPromptTemplate, ExtractionPromptValue
+from langchain.schema import AIMessage, BaseMessage, HumanMessage, PromptValue, SystemMessage
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
 from config import PROMPT_EXAMPLE
 
@@ -47,7 +50,7 @@ class ExtractedInformation(BaseModel):
     )
 
 
-def get_schema(llm, user_text, include_example=None):
+def build_schema():
     examples = [
         (
             PROMPT_EXAMPLE,
@@ -103,9 +106,6 @@ def get_schema(llm, user_text, include_example=None):
         many=True,
     )
 
-    if include_example:
-        examples.append(include_example)
-
     schema = Object(
         id="extracted_information",
         description="Measured metrics about one or more countries",
@@ -121,6 +121,77 @@ def get_schema(llm, user_text, include_example=None):
         many=True,
     )
 
-    chain = create_extraction_chain(llm, schema, encoder_or_encoder_class="json")
-    result = chain.predict_and_parse(text=user_text)
-    return result
+    return schema
+
+
+class PreparedExtractionPromptTemplate(ExtractionPromptTemplate):
+    """
+    Extraction prompt whose instruction segment and schema examples are rendered once, instead of
+    on every call. Per-request examples are passed as `extra_examples` and appended to the
+    prepared ones.
+    """
+
+    instruction_segment: str
+    encoded_examples: List[Tuple[str, str]]
+
+    @classmethod
+    def from_template(cls, template: ExtractionPromptTemplate):
+        return cls(
+            input_variables=["text", "extra_examples"],
+            output_parser=template.output_parser,
+            encoder=template.encoder,
+            node=template.node,
+            input_formatter=template.input_formatter,
+            type_descriptor=template.type_descriptor,
+            instruction_template=template.instruction_template,
+            instruction_segment=template.format_instruction_segment(template.node),
+            encoded_examples=template.generate_encoded_examples(template.node),
+        )
+
+    def encode_extra_examples(self, extra_examples) -> List[Tuple[str, str]]:
+        return encode_examples(
+            [(text, {self.node.id: output}) for text, output in extra_examples],
+            self.encoder,
+            input_formatter=self.input_formatter,
+        )
+
+    def format_prompt(self, text: str, extra_examples=()) -> PromptValue:  # type: ignore[override]
+        text = format_text(text, input_formatter=self.input_formatter)
+        # kor lists the node's own examples before those of its attributes; keep that order.
+        node_examples = len(self.node.examples)
+        examples = (
+            self.encoded_examples[:node_examples]
+            + self.encode_extra_examples(extra_examples)
+            + self.encoded_examples[node_examples:]
+        )
+
+        messages: List[BaseMessage] = [SystemMessage(content=self.instruction_segment)]
+        lines = []
+        for example_input, example_output in examples:
+            messages.extend([HumanMessage(content=example_input), AIMessage(content=example_output)])
+            lines.extend([f"Input: {example_input}", f"Output: {example_output}"])
+        messages.append(HumanMessage(content=text))
+        lines.append(f"Input: {text}\nOutput:")
+        string = self.instruction_segment + "\n\n" + "\n".join(lines)
+        return ExtractionPromptValue(string=string, messages=messages)
+
+
+SCHEMA = build_schema()
+
+
+def build_chain(llm):
+    chain = create_extraction_chain(llm, SCHEMA, encoder_or_encoder_class="json")
+    chain.prompt = PreparedExtractionPromptTemplate.from_template(chain.prompt)
+    return chain
+
+
+def extra_examples(include_example=None):
+    return [include_example] if include_example else []
+
+
+def get_schema(chain, user_text, include_example=None):
+    return chain.predict_and_parse(text=user_text, extra_examples=extra_examples(include_example))
+
+
+async def aget_schema(chain, user_text, include_example=None):
+    return await chain.apredict_and_parse(text=user_text, extra_examples=extra_examples(include_example))
@@ -0,0 +1,246 @@
+import bisect
+import copy
+import functools
+import re
+from collections import defaultdict
+from typing import Dict, List, Optional, Sequence, Set
+
+import numpy
+
+from config import FUZZY_MATCH_LIMIT, FUZZY_MATCH_THRESHOLD
+from services.validation_store import ValidationStore
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+SEARCHABLE_COLUMNS = ("indicator", "source")
+
+
+def tokenize(value: str):
+    return TOKEN_PATTERN.findall(value.lower())
+
+
+class TokenIndex:
+    """Inverted index of lower-cased word tokens to row positions for one column."""
+
+    def __init__(self, values: List[Optional[str]]):
+        self.values = values
+        self.postings: Dict[str, Set[int]] = defaultdict(set)
+        for row, value in enumerate(values):
+            if isinstance(value, str):
+                for token in tokenize(value):
+                    self.postings[token].add(row)
+        self.vocabulary = sorted(self.postings)
+        self.reversed_vocabulary = sorted(token[::-1] for token in self.postings)
+
+    def with_rows(self, values: List[Optional[str]]) -> "TokenIndex":
+        """
+        A copy that also indexes the rows of `values` past the ones indexed here. Only the postings
+        the new rows add to are copied, so this index keeps serving unchanged meanwhile.
+        """
+        index = copy.copy(self)
+        index.values = values
+        index.postings = defaultdict(set, self.postings)
+        copied = set()
+        for row in range(len(self.values), len(values)):
+            if isinstance(values[row], str):
+                for token in tokenize(values[row]):
+                    if token not in copied:
+                        index.postings[token] = set(self.postings.get(token, ()))
+                        copied.add(token)
+                    index.postings[token].add(row)
+        new_tokens = [token for token in copied if token not in self.postings]
+        if new_tokens:
+            index.vocabulary = sorted(self.vocabulary + new_tokens)
+            index.reversed_vocabulary = sorted(self.reversed_vocabulary + [token[::-1] for token in new_tokens])
+        return index
+
+    def _prefixed(self, vocabulary, prefix):
+        start = bisect.bisect_left(vocabulary, prefix)
+        end = bisect.bisect_left(vocabulary, prefix + "\uffff")
+        return vocabulary[start:end]
+
+    def _token_rows(self, token, left_complete, right_complete):
+        if left_complete and right_complete:
+            return self.postings.get(token, set())
+        if left_complete:
+            tokens = self._prefixed(self.vocabulary, token)
+        elif right_complete:
+            tokens = [match[::-1] for match in self._prefixed(self.reversed_vocabulary, token[::-1])]
+        else:
+            tokens = [candidate for candidate in self.vocabulary if token in candidate]
+        rows = set()
+        for candidate in tokens:
+            rows |= self.postings[candidate]
+        return rows
+
+    def candidates(self, needle: str) -> Optional[Set[int]]:
+        """
+        Rows that may contain `needle` as a substring. Tokens at the edges of the needle may be
+        partial words in the indexed value, so they are matched as prefixes/suffixes of the
+        vocabulary. Returns None when the needle has no tokens to filter on.
+        """
+        lowered = needle.lower()
+        rows = None
+        for match in TOKEN_PATTERN.finditer(lowered):
+            left_complete = match.start() > 0
+            right_complete = match.end() < len(lowered)
+            token_rows = self._token_rows(match.group(), left_complete, right_complete)
+            rows = token_rows if rows is None else rows & token_rows
+            if not rows:
+                return set()
+        return rows
+
+    def filter(self, rows, needle: str):
+        candidates = self.candidates(needle)
+        if candidates is not None:
+            rows = [row for row in rows if row in candidates]
+        return [row for row in rows if isinstance(self.values[row], str) and needle in self.values[row]]
+
+
+def trigrams(value: str) -> Set[str]:
+    """Trigrams of each word padded with spaces, so word order does not affect similarity."""
+    grams = set()
+    for token in tokenize(value):
+        padded = f" {token} "
+        grams.update(padded[position:position + 3] for position in range(len(padded) - 2))
+    return grams
+
+
+class TrigramIndex:
+    """Trigram postings over a list of distinct strings, scored with a vectorized Dice coefficient."""
+
+    def __init__(self, strings: Sequence[str]):
+        self.size = len(strings)
+        self.counts = numpy.zeros(self.size, dtype=numpy.float32)
+        postings = defaultdict(list)
+        for position, string in enumerate(strings):
+            grams = trigrams(string)
+            self.counts[position] = len(grams)
+            for gram in grams:
+                postings[gram].append(position)
+        self.postings = {gram: numpy.asarray(positions, dtype=numpy.int32) for gram, positions in postings.items()}
+
+    def extended(self, strings: Sequence[str]) -> "TrigramIndex":
+        """A copy that also indexes `strings`, numbered after the strings indexed here."""
+        added = TrigramIndex(strings)
+        index = copy.copy(self)
+        index.size = self.size + added.size
+        index.counts = numpy.concatenate([self.counts, added.counts])
+        index.postings = dict(self.postings)
+        for gram, positions in added.postings.items():
+            previous = self.postings.get(gram, numpy.empty(0, dtype=numpy.int32))
+            index.postings[gram] = numpy.concatenate([previous, positions + self.size])
+        return index
+
+    def scores(self, query: str) -> numpy.ndarray:
+        """Similarity in [0, 1] of the query to every indexed string."""
+        grams = trigrams(query)
+        hits = [self.postings[gram] for gram in grams if gram in self.postings]
+        if not hits:
+            return numpy.zeros(self.size, dtype=numpy.float32)
+        shared = numpy.bincount(numpy.concatenate(hits), minlength=self.size)
+        return (2 * shared / (len(grams) + self.counts)).astype(numpy.float32)
+
+
+class LookupEngine:
+    """
+    Resolves candidate rows of the validation data without evaluating a DataFrame query.
+    Rows are hash-indexed by country, and `indicator`/`source` are served from token indexes.
+    Built once at startup.
+    """
+
+    def __init__(self, validation_data: ValidationStore):
+        self.countries: Dict[str, List[int]] = defaultdict(list)
+        for row, country in enumerate(validation_data.column("country").to_list()):
+            # A few rows spell their country with stray whitespace ("Kenya ").
+            self.countries[country.strip() if isinstance(country, str) else country].append(row)
+        self.token_indexes = {
+            column: TokenIndex(validation_data.column(column).to_list()) for column in SEARCHABLE_COLUMNS
+        }
+        indicators = validation_data.column("indicator")
+        self.indicator_codes = numpy.asarray(indicators.codes)
+        self.indicator_index = TrigramIndex(list(indicators.categories))
+        self.indicator_scores = functools.lru_cache(maxsize=4096)(self._indicator_scores)
+
+    def with_rows(self, validation_data: ValidationStore) -> "LookupEngine":
+        """
+        A copy for a store with rows appended to the one this engine was built for (see
+        `ValidationStore.with_delta`). Only the new rows are indexed; everything they do not
+        touch is shared with this engine.
+        """
+        engine = copy.copy(self)
+        first_row = len(self.indicator_codes)
+        countries = validation_data.column("country")
+        engine.countries = defaultdict(list, self.countries)
+        for row in range(first_row, validation_data.row_count):
+            country = countries[row]
+            country = country.strip() if isinstance(country, str) else country
+            engine.countries[country] = engine.countries.get(country, []) + [row]
+        engine.token_indexes = {}
+        for column, index in self.token_indexes.items():
+            values = validation_data.column(column)
+            engine.token_indexes[column] = index.with_rows(
+                index.values + [values[row] for row in range(first_row, validation_data.row_count)]
+            )
+        indicators = validation_data.column("indicator")
+        engine.indicator_codes = numpy.asarray(indicators.codes)
+        engine.indicator_index = self.indicator_index.extended(indicators.categories[self.indicator_index.size:])
+        engine.indicator_scores = functools.lru_cache(maxsize=4096)(engine._indicator_scores)
+        return engine
+
+    def _indicator_scores(self, indicator: str) -> numpy.ndarray:
+        """Similarity of `indicator` to each row's indicator; rows without one score 0."""
+        scores = numpy.append(self.indicator_index.scores(indicator), numpy.float32(0))
+        return scores[self.indicator_codes]
+
+    def rank_indicator(self, rows, indicator: str) -> List[int]:
+        """
+        Rows whose indicator contains `indicator`, best match first. When none does, the rows whose
+        indicator is similar enough (e.g. other word order or one word off) are used instead; when
+        none is, no rows.
+        """
+        scores = self.indicator_scores(indicator)
+        matches = numpy.asarray(self.token_indexes["indicator"].filter(rows, indicator), dtype=numpy.int64)
+        limit = None
+        if not len(matches):
+            candidates = numpy.asarray(rows, dtype=numpy.int64)
+            matches = candidates[scores[candidates] >= FUZZY_MATCH_THRESHOLD]
+            limit = FUZZY_MATCH_LIMIT
+        order = numpy.argsort(-scores[matches], kind="stable")[:limit]
+        return matches[order].tolist()
+
+    def indicator_rows(self, country: str, indicator: str = None) -> List[int]:
+        """
+        Rows of `country` ranked by `indicator` (see `rank_indicator`). Rows with no indicator that
+        contains or resembles it are final: the claim resolves to no rows instead of to every row
+        of the country.
+        """
+        rows = self.countries.get(country, [])
+        if indicator and rows:
+            rows = self.rank_indicator(rows, indicator)
+        return rows
+
+    def filter_source(self, rows: List[int], source: str = None) -> List[int]:
+        """The rows whose source contains `source`; when none does, the source is dropped, as the old query loop did."""
+        if source and rows:
+            return self.token_indexes["source"].filter(rows, source) or rows
+        return rows
+
+    def resolve(self, country: str, indicator: str = None, source: str = None) -> List[int]:
+        """Rows of `country` matching the indicator and the source; the indicator is never dropped."""
+        return self.filter_source(self.indicator_rows(country, indicator), source)
+
+    def resolve_many(self, queries) -> Dict:
+        """
+        Resolve many (country, indicator, source) queries. The rows of a country are ranked once
+        per distinct indicator, and the sources of all queries for that indicator are filtered
+        from the ranked rows.
+        """
+        by_indicator = defaultdict(set)
+        for query in queries:
+            by_indicator[query[:2]].add(query)
+        resolved = {}
+        for (country, indicator), indicator_queries in by_indicator.items():
+            rows = self.indicator_rows(country, indicator)
+            for query in indicator_queries:
+                resolved[query] = self.filter_source(rows, query[2])
+        return resolved
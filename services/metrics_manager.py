@@ -1,14 +1,22 @@
+import bisect
 import dataclasses
+import time
 from pprint import pprint
-from string import punctuation
-from typing import Dict, List
+from typing import Dict, List, Optional
 
-import pandas
 from fastapi import HTTPException
 
 from config import ERROR_REASONS
-from services import STARTUP_OBJECTS
+from services.country_resolver import CountryResolver
+from services.dataset import Dataset, current_dataset
+from services.lookup_engine import LookupEngine
+from services.number_scanner import locate_values, number_occurrences
+from services.validation_store import ValidationStore
 from services.pandas_query import PandasQuery, CountryMetric, Validity
+from services import profiling
+from services.sentence_splitter import regex_span_tokenize
+from services.telemetry import EXTRACTION_ERRORS, STAGE_SECONDS, VALIDATED_METRICS, stage
+from services.validator import Validator
 
 
 @dataclasses.dataclass
@@ -25,7 +33,7 @@ class Position:
 
 @dataclasses.dataclass
 class Match:
-    position: Position
+    position: Optional[Position]
     message: str
     openai_extract: CountryMetric = None
     kwerty_validation: Dict = None
@@ -45,6 +53,7 @@ class MetricMatch:
 class CountryResultManager:
     metric_match: MetricMatch = None
     error: ExtractionError = None
+    dataset_version: str = None
 
     def __post_init__(self):
         if not self.error:
@@ -52,18 +61,31 @@ class CountryResultManager:
 
 
 class MetricsManager:
-    def __init__(self, user_text: str, country_data: List[Dict]):
+    def __init__(self, user_text: str, country_data: List[Dict], resolved_rows: Dict = None, dataset: Dataset = None):
         self.user_text = user_text
+        self.resolved_rows = resolved_rows
         self.country_data = country_data
-        self.validation_data: pandas.DataFrame = STARTUP_OBJECTS["validation_data"]
+        self.dataset = dataset or current_dataset()
+        self.validation_data: ValidationStore = self.dataset.validation_data
+        self.lookup_engine: LookupEngine = self.dataset.lookup_engine
+        self.country_resolver: CountryResolver = self.dataset.country_resolver
+        self.validator = Validator(self.validation_data)
+        self.sentence_spans = None
+        # Number spans per (start, end) chunk, shared by all country entries of the chunk.
+        self.occurrences = {}
         self.columns = self.get_columns()
-        self.result = CountryResultManager()
+        self.result = CountryResultManager(dataset_version=self.dataset.version)
 
+    @profiling.span("MetricsManager.process_metrics")
     def process_metrics(self):
         country_names = self.get_supported_countries()
         for country_information in self.country_data:
-            country_name = country_information.get("country", self.guess_country_name(country_names))
+            with stage("country_resolution"):
+                country_name = self.country_resolver.canonical(country_information.get("country"))
+                if not country_name:
+                    country_name = self.guess_country_name(country_information.get("text_offset", 0))
             if not country_name:
+                EXTRACTION_ERRORS.inc(reason="CountryMissing")
                 if not country_name:
                     raise HTTPException(
                         status_code=502,
@@ -73,75 +95,93 @@ class MetricsManager:
                         },
                     )
             if country_name not in country_names:
+                EXTRACTION_ERRORS.inc(reason="CountryNotSupported")
                 self.result.error = ExtractionError(
                     error=True, error_reason=ERROR_REASONS["CountryNotSupported"]
                 )
             else:
                 metrics = country_information["country_metrics"]
                 if not metrics:
+                    EXTRACTION_ERRORS.inc(reason="NoMetricsFound")
                     self.result.error = ExtractionError(
                         error=True, error_reason=ERROR_REASONS["NoMetricsFound"]
                     )
                 else:
                     metrics = [CountryMetric(**metric) for metric in metrics]
                     metric_values = [metric.metric_value for metric in metrics]
-                    try:
-                        for metric, offset in zip(
-                                metrics,
-                                self.get_word_positions(self.user_text, metric_values),
-                                # strict=True
+                    text_offset = country_information.get("text_offset", 0)
+                    text_end = country_information.get("text_end")
+                    # Metrics whose value is not found in their chunk get no position.
+                    spans = locate_values(
+                        self.user_text, metric_values, occurrences=self.chunk_occurrences(text_offset, text_end)
+                    )
+                    pandas_query_handlers = [
+                        PandasQuery(
+                            country_name=country_name,
+                            metric=metric,
+                            validation_data=self.validation_data,
+                            columns=self.columns,
+                            lookup_engine=self.lookup_engine,
+                            resolved_rows=self.resolved_rows,
+                            context=self.sentence_at(span.start) if span else None,
+                        )
+                        for metric, span in zip(metrics, spans)
+                    ]
+                    # A metric's query time is its claim plus reading back its result; the check of
+                    # all claims of the country, in one pass over the stored cells, is timed apart.
+                    claims, query_seconds = [], []
+                    for handler in pandas_query_handlers:
+                        started = time.perf_counter()
+                        with profiling.span(
+                                "PandasQuery.claim", country=country_name, metric=handler.metric.metric_name
+                        ):
+                            claims.append(handler.claim())
+                        query_seconds.append(time.perf_counter() - started)
+                    with stage("validation", claims=len(claims)):
+                        validation = self.validator.validate(claims)
+                    for index, (metric, span, pandas_query_handler) in enumerate(
+                            zip(metrics, spans, pandas_query_handlers)
+                    ):
+                        started = time.perf_counter()
+                        with profiling.span(
+                                "PandasQuery.apply_result", country=country_name, metric=metric.metric_name
                         ):
-                            pandas_query_handler = PandasQuery(
-                                country_name=country_name,
-                                metric=metric,
-                                validation_data=self.validation_data,
-                                columns=self.columns,
-                            )
-
-                            validated_data = pandas_query_handler.run_query()
-                            print(validated_data)
-                            match = Match(
-                                position=Position(
-                                    length=len(metric.metric_value), offset=offset
-                                ),
-                                openai_extract=metric,
-                                kwerty_validation=validated_data,
-                                validity=pandas_query_handler.validity,
-                                message=pandas_query_handler.message,
-                            )
-                            self.result.metric_match.matches.append(match)
-                    except ValueError:
-                        raise HTTPException(
-                            status_code=502,
-                            detail={
-                                "message": "Metric match. The metric count in the sentence does not match the count "
-                                           "returned by OpenAI",
-                                "error_type": "METRIC_MISMATCH",
-                                "data": self.country_data,
-                            },
+                            validated_data = pandas_query_handler.apply_result(validation, index)
+                        STAGE_SECONDS.observe(
+                            query_seconds[index] + time.perf_counter() - started, stage="pandas_query"
                         )
+                        VALIDATED_METRICS.inc(reason=pandas_query_handler.validity.invalidity_reason or "none")
+                        match = Match(
+                            position=Position(offset=span.start, length=span.end - span.start) if span else None,
+                            openai_extract=metric,
+                            kwerty_validation=validated_data,
+                            validity=pandas_query_handler.validity,
+                            message=pandas_query_handler.message,
+                        )
+                        self.result.metric_match.matches.append(match)
 
         return self.result
 
+    def chunk_occurrences(self, start: int, end: Optional[int]):
+        if (start, end) not in self.occurrences:
+            self.occurrences[start, end] = number_occurrences(self.user_text, start, end)
+        return self.occurrences[start, end]
+
+    def sentence_at(self, offset: int) -> str:
+        if self.sentence_spans is None:
+            self.sentence_spans = regex_span_tokenize(self.user_text)
+        index = bisect.bisect_right([start for start, _ in self.sentence_spans], offset) - 1
+        if index < 0:
+            return ""
+        start, end = self.sentence_spans[index]
+        return self.user_text[start:end]
+
     def get_supported_countries(self):
-        return set(self.validation_data["country"].to_list())
+        return self.country_resolver.countries
 
     def get_columns(self):
-        return set(self.validation_data.columns.to_list())
-
-    @staticmethod
-    def get_word_positions(text, metric_values):
-        positions = []
-        for index, word in enumerate(text.split()):
-            if word.rstrip(punctuation) in metric_values:
-                positions.append(index)
-
-        return positions
-
-    def guess_country_name(self, country_names):
-        valid_countries = set(
-            country for country in country_names if country in [word.rstrip(punctuation) for word in self.user_text.split(" ")]
-        )
-        if valid_countries:
-            return list(valid_countries)[0]
+        return self.validation_data.columns
+
+    def guess_country_name(self, text_offset=0):
+        return self.country_resolver.guess(self.user_text, text_offset)
 
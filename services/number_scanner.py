@@ -0,0 +1,64 @@
+import dataclasses
+import re
+from collections import defaultdict, deque
+from typing import Deque, Dict, List, Optional, Sequence
+
+# A signed integer, optionally with thousands separators, and an optional decimal part. The
+# look-arounds keep numbers out of words ("Q3", "G20") and stop "3.1." or "5.6%" at the number.
+NUMBER_PATTERN = re.compile(r"(?<![\w.])[-+−]?(?:\d{1,3}(?:,\d{3})+|\d+)(?:\.\d+)?(?![\d,]\d)")
+
+
+@dataclasses.dataclass
+class NumberSpan:
+    start: int
+    end: int
+    value: float
+
+
+def parse_number(value) -> Optional[float]:
+    """Numeric value of a number as written ("1,200", "5.6%", "−1.3"), or None."""
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(str(value).replace(",", "").replace("−", "-").strip().rstrip("%").strip())
+    except ValueError:
+        return None
+
+
+def scan_numbers(text: str, start: int = 0, end: int = None) -> List[NumberSpan]:
+    """Character spans of every number in the text between `start` and `end`, in one pass."""
+    return [
+        NumberSpan(start=match.start(), end=match.end(), value=parse_number(match.group()))
+        for match in NUMBER_PATTERN.finditer(text, start, len(text) if end is None else end)
+    ]
+
+
+def number_occurrences(text: str, start: int = 0, end: int = None) -> Dict[float, Deque[NumberSpan]]:
+    """The spans of each number between `start` and `end`, in text order."""
+    occurrences = defaultdict(deque)
+    for span in scan_numbers(text, start, end):
+        occurrences[span.value].append(span)
+    return occurrences
+
+
+def locate_values(
+        text: str, values: Sequence, start: int = 0, end: int = None, occurrences: Dict = None
+) -> List[Optional[NumberSpan]]:
+    """
+    Span of each value in the text, searching between `start` and `end`. Every value takes the
+    first span with the same number that no earlier value took, so a number repeated in the text
+    maps to its successive occurrences. Values that do not occur get None.
+
+    Spans are taken from `occurrences` (see `number_occurrences`) when given; sharing them between
+    the calls for the entries of one chunk keeps those entries from taking the same span.
+    """
+    if occurrences is None:
+        occurrences = number_occurrences(text, start, end)
+    located = []
+    for value in values:
+        number = parse_number(value)
+        remaining = occurrences.get(number)
+        located.append(remaining.popleft() if remaining else None)
+    return located
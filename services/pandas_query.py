@@ -1,11 +1,35 @@
-import calendar
-from datetime import datetime
 from pprint import pprint
-from typing import Set, Dict
-import pandas
+from typing import Dict, Set, Tuple
 from pydantic import BaseModel, dataclasses
 
-MONTH_VARIANTS = [None, "None", "NA", "N/A"]
+from services.lookup_engine import LookupEngine
+from services.periods import claim_period
+from services.profiling import span
+from services.validation_store import ValidationStore
+from services.validator import Claim, ValidationResult, Validator, detect_series
+
+RESULT_FIELDS = (
+    "country",
+    "indicator",
+    "source",
+    "link",
+    "currency_code",
+    "unit",
+    "category",
+    "frequency",
+    "note",
+    "tag",
+    "country_code",
+    "indicator_definition",
+)
+MESSAGES = {
+    None: "The text is correct.",
+    "INVALID_METRIC": "The text contains an error",
+    "INSUFFICIENT_DATA": "The text could not be validated. We do not have enough information to do this.",
+    "MONTH_MISSING": "The text could not be validated. Month missing",
+    "YEAR_MISSING": "The text could not be validated. Year missing",
+    "PERIOD_INFERRED": "The text could not be validated. The period is missing; the value matches the period returned",
+}
 
 
 @dataclasses.dataclass
@@ -30,7 +54,8 @@ class Validity:
 
 @dataclasses.dataclass
 class Queries:
-    base_query: str = None
+    # (country, indicator, source) the rows were resolved with, see `PandasQuery.lookup_query`.
+    base_query: Tuple = None
     metric_query: str = None
     result: Dict = None
 
@@ -40,124 +65,93 @@ class PandasQuery:
             self,
             country_name: str,
             metric: CountryMetric,
-            validation_data: pandas.DataFrame,
+            validation_data: ValidationStore,
             columns: Set[str],
+            lookup_engine: LookupEngine,
+            resolved_rows: Dict = None,
+            context: str = None,
     ):
         self.country_name = country_name
         self.metric = metric
+        # The sentence the metric was stated in, for wording such as "year-on-year".
+        self.context = context
         self.validation_data = validation_data
+        self.lookup_engine = lookup_engine
+        self.resolved_rows = resolved_rows or {}
         self.columns = columns
         self.queries = Queries()
         self.query_validity = QueryValidity()
         self.message = None
         self.validity = Validity()
-
-    def _run_query(self, query):
-        got_result = False
-        result = None
-        formatted_query = query
-        while not got_result:
-            query_result = self.validation_data.query(formatted_query)
-            if not query_result.empty:
-                got_result = True
-                result = query_result
-            formatted_query = "and".join(query.split("and")[:-1])
-
-        if got_result:
-            return result
-
-    def build_base_query(self):
-        query_string = f"country=='{self.country_name}'"
-        if self.metric.metric_name:
-            query_string = f"{query_string} and indicator.str.contains('{self.metric.metric_name.title()}')"
-        if self.metric.metric_source:
-            query_string = f"{query_string} and source.str.contains('{self.metric.metric_source}')"
-
-        self.queries.base_query = query_string
-        return query_string
+        self.missing_period = None
 
     @staticmethod
-    def build_month_year_format(month, year):
-        if month in MONTH_VARIANTS or not year or len(month) < 3:
-            today = datetime.now()
-            return f"{calendar.month_abbr[3]}_{str(today.year)[2:]}"
-        return f"{str(month)[:3]}_{str(year)[2:]}".lower()
+    def lookup_query(country_name, metric: CountryMetric):
+        """(country, indicator, source) the candidate rows of a metric are resolved with."""
+        return (
+            country_name,
+            metric.metric_name.title() if metric.metric_name else None,
+            metric.metric_source,
+        )
+
+    def _run_query(self):
+        query = self.queries.base_query = self.lookup_query(self.country_name, self.metric)
+        rows = self.resolved_rows.get(query)
+        if rows is None:
+            rows = self.lookup_engine.resolve(*query)
+        if rows:
+            return rows
+
+    def year_periods(self, year):
+        """Period columns that fall in `year`: its months, quarters and the year itself."""
+        period = claim_period(None, year)
+        if period is None:
+            return []
+        return [self.validation_data.periods[index] for index in self.validation_data.period_axis.within(period)]
+
+    def claim(self) -> Claim:
+        rows = self._run_query()
+        if not rows:
+            return Claim(rows=rows, period=None, value=self.metric.metric_value)
+        self.queries.metric_query = self.get_metric_key()
+        return Claim(
+            rows=rows,
+            period=self.queries.metric_query,
+            value=self.metric.metric_value,
+            missing=self.missing_period,
+            allowed_periods=self.year_periods(self.metric.metric_year) if self.missing_period == "MONTH_MISSING" else None,
+            series=detect_series(f"{self.metric.metric_name} {self.context or ''}"),
+        )
+
+    def apply_result(self, result: ValidationResult, index: int):
+        """Set the message and validity of claim `index` of a validation and return its row data."""
+        reason = result.reasons[index]
+        self.validity.is_valid = bool(result.is_valid[index])
+        self.message = MESSAGES[reason]
+        if reason:
+            self.validity.invalidity_reason = reason
+        row = int(result.rows[index])
+        if row < 0:
+            return None
+
+        # Only the returned fields and the one period cell are read from the store.
+        return self.validation_data.row(row).project(
+            RESULT_FIELDS, period=result.periods[index], series=result.series[index]
+        )
 
     def run_query(self):
-        base_query = self.build_base_query()
-        base_query_result = self._run_query(base_query)
-
-        dict_query = base_query_result.to_dict(orient="records")
-        print(base_query, len(dict_query))
-        query_status = {
-            "status": None
-        }
-        for query_result in dict_query:
-            metric_key = self.get_metric_key()
-            query_status['metric_key'] = metric_key
-            if metric_key not in query_result:
-                self.message = "The text could not be validated. We do not have enough information to do this."
-                self.validity.is_valid = False
-                self.validity.invalidity_reason = "INSUFFICIENT_DATA"
-            else:
-                if query_result.get(metric_key) == self.metric.metric_value:
-                    self.validity.is_valid = True
-                    self.message = "The text is correct."
-                    query_status['status'] = True
-                    query_status['result'] = query_result
-                    break
-                else:
-                    self.message = "The text contains an error"
-                    self.validity.is_valid = False
-                    self.validity.invalidity_reason = "INVALID_METRIC"
-                    query_status['result'] = query_result
-
-        if 'result' in query_status:
-            country_data = {
-                "country": query_status['result']["country"],
-                "indicator": query_status['result']["indicator"],
-                "source": query_status['result']["source"],
-                "link": query_status['result']["link"],
-                "currency_code": query_status['result']["currency_code"],
-                "unit": query_status['result']["unit"],
-                "category": query_status['result']["category"],
-                "frequency": query_status['result']["frequency"],
-                "note": query_status['result']["note"],
-                "tag": query_status['result']["tag"],
-                "country_code": query_status['result']["country_code"],
-                "indicator_definition": query_status['result']["indicator_definition"],
-                "value": query_status['result'].get(query_status['metric_key']),
-            }
-            return self.serialize_result(country_data)
+        with span("PandasQuery.run_query", country=self.country_name, metric=self.metric.metric_name):
+            result = Validator(self.validation_data).validate([self.claim()])
+            return self.apply_result(result, 0)
 
     def get_metric_key(self):
-        metric_key = None
-        if self.metric.metric_month:
-            if self.metric.metric_year:
-                month_year = self.build_month_year_format(self.metric.metric_month, self.metric.metric_year)
-                if "Unk" in month_year:
-                    self.message = "The text could not be validated. Month missing"
-                    self.validity.is_valid = False
-                    self.validity.invalidity_reason = "MONTH_MISSING"
-                else:
-                    metric_key = month_year
-        else:
-            if self.metric.metric_year:
-                if "Unk" in self.metric.metric_year:
-                    self.message = "The text could not be validated. Year missing"
-                    self.validity.is_valid = False
-                    self.validity.invalidity_reason = "YEAR_MISSING"
-                else:
-                    metric_key = self.metric.metric_year
-        return metric_key
-
-    @staticmethod
-    def serialize_result(country_data):
-        for key, value in country_data.items():
-            try:
-                if pandas.isna(value):
-                    country_data[key] = None
-            except ValueError:
-                if value.empty:
-                    country_data[key] = None
-        return country_data
+        """Period column of the claim, or None with `missing_period` saying what is missing."""
+        month, year = self.metric.metric_month, self.metric.metric_year
+        if claim_period(None, year) is None:
+            self.missing_period = "YEAR_MISSING"
+            return None
+        period = claim_period(month, year)
+        if period is None:
+            self.missing_period = "MONTH_MISSING"
+            return None
+        return period.name
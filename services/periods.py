@@ -0,0 +1,112 @@
+"""
+Common time axis of the dataset's period columns. Monthly (`mar_03`), quarterly (`q1_2003`) and
+annual (`2003`) columns are all mapped to the month they start in, counted from year 0, and the
+number of months they cover, so "which columns fall in 2003" is a comparison over two arrays.
+"""
+import calendar
+import dataclasses
+import re
+from typing import List, Optional
+
+import numpy
+
+MONTHS = [month.lower() for month in calendar.month_abbr[1:]]
+MONTHLY_COLUMN = re.compile(r"^([a-z]{3})_(\d{2})$")
+QUARTERLY_COLUMN = re.compile(r"^q([1-4])_(\d{4})$")
+ANNUAL_COLUMN = re.compile(r"^(\d{4})$")
+CLAIMED_YEAR = re.compile(r"\b(\d{4})\b")
+CLAIMED_QUARTER = re.compile(r"^(?:q([1-4])|([1-4])(?:st|nd|rd|th)? quarter|(first|second|third|fourth) quarter)$")
+QUARTER_WORDS = {"first": 1, "second": 2, "third": 3, "fourth": 4}
+# Two-digit years below this are 20xx, the rest 19xx; the data starts in 1980.
+CENTURY_PIVOT = 50
+
+
+@dataclasses.dataclass(frozen=True)
+class Period:
+    start: int
+    months: int
+
+    @property
+    def year(self) -> int:
+        return self.start // 12
+
+    @property
+    def name(self) -> str:
+        """Column name of the period in the dataset's naming scheme."""
+        if self.months == 1:
+            return f"{MONTHS[self.start % 12]}_{self.year % 100:02d}"
+        if self.months == 3:
+            return f"q{self.start % 12 // 3 + 1}_{self.year}"
+        return str(self.year)
+
+
+def parse_period(column: str) -> Optional[Period]:
+    if match := MONTHLY_COLUMN.match(column):
+        if match.group(1) not in MONTHS:
+            return None
+        year = int(match.group(2))
+        year += 2000 if year < CENTURY_PIVOT else 1900
+        return Period(start=year * 12 + MONTHS.index(match.group(1)), months=1)
+    if match := QUARTERLY_COLUMN.match(column):
+        return Period(start=int(match.group(2)) * 12 + (int(match.group(1)) - 1) * 3, months=3)
+    if match := ANNUAL_COLUMN.match(column):
+        return Period(start=int(match.group(1)) * 12, months=12)
+    return None
+
+
+def claim_period(month, year) -> Optional[Period]:
+    """
+    Period of an extracted month ("March", "Q1", "third quarter" or none) and year, or None when
+    the year is not a year or the month is neither a month nor a quarter.
+    """
+    match = CLAIMED_YEAR.search(str(year or ""))
+    if not match:
+        return None
+    year = int(match.group(1))
+    if not month:
+        return Period(start=year * 12, months=12)
+    month = str(month).strip().lower()
+    if quarter := CLAIMED_QUARTER.match(month):
+        number = int(quarter.group(1) or quarter.group(2) or QUARTER_WORDS[quarter.group(3)])
+        return Period(start=year * 12 + (number - 1) * 3, months=3)
+    if month[:3] in MONTHS and len(month) >= 3:
+        return Period(start=year * 12 + MONTHS.index(month[:3]), months=1)
+    return None
+
+
+class PeriodAxis:
+    """Start month and length of every period id of a store; unparsable columns have length 0."""
+
+    def __init__(self, periods: List[str]):
+        parsed = [parse_period(period) for period in periods]
+        self.starts = numpy.array([period.start if period else -1 for period in parsed], dtype=numpy.int32)
+        self.months = numpy.array([period.months if period else 0 for period in parsed], dtype=numpy.int8)
+
+    def extended(self, periods: List[str]) -> "PeriodAxis":
+        """The axis with `periods` appended as the next period ids; only those are parsed."""
+        added = PeriodAxis(periods)
+        axis = PeriodAxis([])
+        axis.starts = numpy.concatenate([self.starts, added.starts])
+        axis.months = numpy.concatenate([self.months, added.months])
+        return axis
+
+    def shifted(self, months: int, lengths=(1, 3, 12)) -> numpy.ndarray:
+        """For every period id, the id of the period of the same length `months` earlier, or -1."""
+        index = {
+            (start, length): period_id
+            for period_id, (start, length) in enumerate(zip(self.starts.tolist(), self.months.tolist()))
+            if length
+        }
+        return numpy.array(
+            [
+                index.get((start - months, length), -1) if length in lengths else -1
+                for start, length in zip(self.starts.tolist(), self.months.tolist())
+            ],
+            dtype=numpy.int64,
+        )
+
+    def within(self, period: Period) -> numpy.ndarray:
+        """Ids of the periods that lie inside `period`, e.g. the months and quarters of a year."""
+        return numpy.flatnonzero(
+            (self.months > 0) & (self.starts >= period.start) & (self.starts + self.months <= period.start + period.months)
+        )
@@ -0,0 +1,129 @@
+"""
+Opt-in profiling of a single request, enabled with `KwertyAPIConfig.profiling_enabled`. A profiled
+request runs under cProfile and records a tree of spans (the stages, the LLM extraction, the
+metrics processing and the query of every metric) with their timings. Both are written to
+PROFILE_OUTPUT_PATH and summarized in the response.
+
+cProfile is deterministic and hooks the thread it is enabled on: while the request awaits the
+LLM, whatever else the event loop runs is profiled too, so profile on an otherwise idle worker.
+Only one request per process is profiled at a time.
+"""
+import contextlib
+import contextvars
+import cProfile
+import dataclasses
+import json
+import os
+import pstats
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional
+
+from config import PROFILE_OUTPUT_PATH, PROFILE_TOP_FUNCTIONS
+
+CURRENT_SPAN: contextvars.ContextVar = contextvars.ContextVar("current_span", default=None)
+PROFILER_LOCK = threading.Lock()
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+@dataclasses.dataclass
+class Span:
+    name: str
+    start: float
+    attributes: Dict = dataclasses.field(default_factory=dict)
+    duration: Optional[float] = None
+    children: List["Span"] = dataclasses.field(default_factory=list)
+
+    def to_dict(self, origin: float) -> Dict:
+        """The span and its children, with times in milliseconds since `origin`."""
+        return {
+            "name": self.name,
+            "start_ms": round((self.start - origin) * 1000, 3),
+            "duration_ms": None if self.duration is None else round(self.duration * 1000, 3),
+            "attributes": self.attributes,
+            "children": [child.to_dict(origin) for child in self.children],
+        }
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes):
+    """
+    Record the `with` block as a child of the current span. Outside a profiled request there is no
+    current span and this only costs a context variable lookup. Tasks started inside the block
+    (e.g. by `asyncio.gather`) copy the context, so their spans nest under it as well.
+    """
+    parent = CURRENT_SPAN.get()
+    if parent is None:
+        yield None
+        return
+    current = Span(name=name, start=time.perf_counter(), attributes=attributes)
+    parent.children.append(current)
+    token = CURRENT_SPAN.set(current)
+    try:
+        yield current
+    finally:
+        current.duration = time.perf_counter() - current.start
+        CURRENT_SPAN.reset(token)
+
+
+class RequestProfile:
+    """Profiles the `with` block of one request: cProfile plus the root of its span tree."""
+
+    def __init__(self, name: str, **attributes):
+        self.id = uuid.uuid4().hex
+        self.profiler = cProfile.Profile()
+        self.root = Span(name=name, start=0.0, attributes=attributes)
+        self.token = None
+
+    def __enter__(self):
+        if not PROFILER_LOCK.acquire(blocking=False):
+            raise ProfilerBusy("Another request is being profiled")
+        self.root.start = time.perf_counter()
+        self.token = CURRENT_SPAN.set(self.root)
+        self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.disable()
+        self.root.duration = time.perf_counter() - self.root.start
+        CURRENT_SPAN.reset(self.token)
+        PROFILER_LOCK.release()
+        return False
+
+    def top_functions(self, limit: int = PROFILE_TOP_FUNCTIONS) -> List[Dict]:
+        """The functions with the most cumulative time, as in `pstats` sorted by "cumulative"."""
+        stats = pstats.Stats(self.profiler).stats
+        slowest = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:limit]
+        return [
+            {
+                "function": f"{name} ({filename}:{line})",
+                "calls": calls,
+                "total_ms": round(total * 1000, 3),
+                "cumulative_ms": round(cumulative * 1000, 3),
+            }
+            for (filename, line, name), (_, calls, total, cumulative, _) in slowest
+        ]
+
+    def save(self, directory: str = PROFILE_OUTPUT_PATH) -> Dict:
+        """
+        Write the profile (`<id>.prof`, for pstats or snakeviz) and the span tree
+        (`<id>.spans.json`), and return a summary of both for the response.
+        """
+        os.makedirs(directory, exist_ok=True)
+        profile_path = os.path.join(directory, f"{self.id}.prof")
+        spans_path = os.path.join(directory, f"{self.id}.spans.json")
+        self.profiler.dump_stats(profile_path)
+        spans = self.root.to_dict(self.root.start)
+        with open(spans_path, "w") as output:
+            json.dump(spans, output, indent=2, default=str)
+        return {
+            "id": self.id,
+            "profile_path": profile_path,
+            "spans_path": spans_path,
+            "spans": spans,
+            "top_functions": self.top_functions(),
+        }
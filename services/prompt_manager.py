@@ -1,8 +1,11 @@
+import asyncio
+import functools
 import json
 from pprint import pprint
 
 import openai
 from fastapi import HTTPException
+from langchain.callbacks import get_openai_callback
 from langchain.chat_models import ChatOpenAI
 
 from config import (
@@ -13,8 +16,14 @@ from config import (
     MAX_TOKENS,
     SUMMARY_INSTRUCTION,
     FORMAT_JSON_STRING,
+    LLM_MAX_CONCURRENCY,
 )
-from services.kor_schema import get_schema
+from services.kor_schema import aget_schema, build_chain, get_schema
+from services.profiling import span
+from services.telemetry import LLM_REQUESTS, LLM_TOKENS, stage
+
+# Caps the number of in-flight OpenAI calls per worker, however many requests are waiting on them.
+LLM_SEMAPHORE = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
 
 
 class KorPromptManager:
@@ -25,7 +34,26 @@ class KorPromptManager:
     def get_msg(data, **_):
         return data.get("messages")[-1].content
 
-    def run(self, previous=None):
+    @staticmethod
+    def build_llm(max_tokens):
+        return ChatOpenAI(
+            model="gpt-3.5-turbo",
+            temperature=MODEL_TEMPERATURE,
+            max_tokens=max_tokens,
+            top_p=MODEL_TOP_P,
+            n=MODEL_N,
+            frequency_penalty=0.2,
+            presence_penalty=0.8,
+        )
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def get_chain(max_tokens):
+        """The client and extraction chain are built once per token budget and shared by all requests."""
+        return build_chain(KorPromptManager.build_llm(max_tokens))
+
+    @staticmethod
+    def build_example(previous=None):
         max_tokens = MAX_TOKENS
         include_example = None
         if previous:
@@ -34,29 +62,56 @@ class KorPromptManager:
                 previous['metrics']
             )
             max_tokens -= 500
+        return include_example, max_tokens
+
+    @staticmethod
+    def record_usage(callback):
+        LLM_TOKENS.inc(callback.prompt_tokens, kind="prompt")
+        LLM_TOKENS.inc(callback.completion_tokens, kind="completion")
+
+    @staticmethod
+    def extraction_error(error):
+        LLM_REQUESTS.inc(outcome="error")
+        return HTTPException(
+            status_code=502,
+            detail={
+                "message": "Something went wrong while extracting the data",
+                "error": True,
+                "details": str(error)
+            },
+        )
+
+    def run(self, previous=None):
+        include_example, max_tokens = self.build_example(previous)
         try:
-            llm = ChatOpenAI(
-                model="gpt-3.5-turbo",
-                temperature=MODEL_TEMPERATURE,
-                max_tokens=max_tokens,
-                top_p=MODEL_TOP_P,
-                n=MODEL_N,
-                frequency_penalty=0.2,
-                presence_penalty=0.8,
-            )
+            chain = self.get_chain(max_tokens)
             pprint(include_example)
-            extracted_schema = get_schema(llm, self.user_text, include_example=include_example)
+            with span("KorPromptManager.run"), stage("llm_extraction"), get_openai_callback() as callback:
+                extracted_schema = get_schema(chain, self.user_text, include_example=include_example)
+            self.record_usage(callback)
+            LLM_REQUESTS.inc(outcome="success")
             return extracted_schema
 
         except Exception as error:
-            raise HTTPException(
-                status_code=502,
-                detail={
-                    "message": "Something went wrong while extracting the data",
-                    "error": True,
-                    "details": str(error)
-                },
-            )
+            raise self.extraction_error(error)
+
+    async def arun(self, previous=None):
+        """Same as `run`, but awaits the OpenAI round trip instead of blocking the event loop."""
+        include_example, max_tokens = self.build_example(previous)
+        try:
+            chain = self.get_chain(max_tokens)
+            # The span includes the wait for the semaphore, the stage only the OpenAI round trip.
+            with span("KorPromptManager.arun"):
+                async with LLM_SEMAPHORE:
+                    # The callback is held in a context variable, so concurrent extractions count apart.
+                    with stage("llm_extraction"), get_openai_callback() as callback:
+                        extracted_schema = await aget_schema(chain, self.user_text, include_example=include_example)
+            self.record_usage(callback)
+            LLM_REQUESTS.inc(outcome="success")
+            return extracted_schema
+
+        except Exception as error:
+            raise self.extraction_error(error)
 
 
 class PromptManager:
@@ -0,0 +1,56 @@
+import functools
+import re
+from typing import List, Tuple
+
+import nltk
+
+from config import SENTENCE_SPLITTER
+from services.telemetry import stage
+
+# A terminator, optional closing quotes/brackets, whitespace, then something that can open a
+# sentence. Decimals such as "5.6" never match since there is no whitespace after their period.
+SENTENCE_BOUNDARY = re.compile(r"[.!?][\"')\]]*\s+(?=[\"'(\[]?[A-Z0-9])")
+ABBREVIATIONS = frozenset(
+    {
+        "mr", "mrs", "ms", "dr", "prof", "sr", "jr", "st", "vs", "etc", "e.g", "i.e", "approx", "est",
+        "no", "nos", "fig", "inc", "ltd", "co", "corp", "dept", "govt", "u.s", "u.k", "u.n", "e.u",
+        "jan", "feb", "mar", "apr", "jun", "jul", "aug", "sep", "sept", "oct", "nov", "dec",
+    }
+)
+
+
+@functools.lru_cache(maxsize=None)
+def load_sentence_tokenizer():
+    """Load and prepare the Punkt model once; called at startup so requests never hit the network."""
+    try:
+        nltk.data.find('tokenizers/punkt')
+    except LookupError:
+        nltk.download('punkt')
+
+    sentence_tokenizer = nltk.data.load('tokenizers/punkt/english.pickle')
+    sentence_tokenizer._params.abbrev_types.update([".", "-", "+"])
+    return sentence_tokenizer
+
+
+def regex_span_tokenize(text: str) -> List[Tuple[int, int]]:
+    spans = []
+    start = len(text) - len(text.lstrip())
+    for boundary in SENTENCE_BOUNDARY.finditer(text):
+        sentence = text[start:boundary.start()]
+        preceding_word = sentence.rsplit(None, 1)[-1].lstrip("\"'([").lower() if sentence.strip() else ""
+        if preceding_word in ABBREVIATIONS or (len(preceding_word) == 1 and preceding_word.isalpha()):
+            continue
+        spans.append((start, boundary.start() + len(boundary.group().rstrip())))
+        start = boundary.end()
+    end = len(text.rstrip())
+    if start < end:
+        spans.append((start, end))
+    return spans
+
+
+def split_text_into_spans(text_: str, splitter: str = None) -> List[Tuple[int, int]]:
+    """(start, end) character offsets of each sentence in the text."""
+    with stage("sentence_split"):
+        if (splitter or SENTENCE_SPLITTER) == "regex":
+            return regex_span_tokenize(text_)
+        return list(load_sentence_tokenizer().span_tokenize(text_))
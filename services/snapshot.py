@@ -0,0 +1,294 @@
+"""
+Binary snapshot of the validation dataset.
+
+Layout: 8 magic bytes, a little-endian uint64 header length, a JSON header, then the raw arrays,
+each starting on a 64 byte boundary. The header records the format version, a checksum of the
+CSV the snapshot was built from, the dataset version (which differs from that checksum once delta
+releases are merged in, see `services.dataset.ingest_delta`), the periods and the dtype/shape/offset
+of every array. The arrays hold the cells (with the keys of those that are derived annual and
+quarterly averages), the derived growth/average series and the reverse value index, so loading is
+a handful of `numpy.frombuffer` calls instead of a CSV parse.
+
+Usage:
+    python -m services.snapshot build [--source kwerty_data.csv] [--output kwerty_data.snapshot]
+    python -m services.snapshot check [--source kwerty_data.csv] [--output kwerty_data.snapshot]
+"""
+import argparse
+import hashlib
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import sys
+import tempfile
+from typing import Dict, Optional
+
+import numpy
+import pandas
+
+from config import MEMORY_MAP_VALIDATION_DATA, VALIDATION_DATA_PATH, VALIDATION_SNAPSHOT_PATH
+from services.validation_store import CellSeries, StringColumn, StringTable, ValidationStore, ValueIndex
+
+MAGIC = b"KWERTYDS"
+FORMAT_VERSION = 5
+ALIGNMENT = 64
+HEADER_LENGTH = struct.Struct("<Q")
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def file_checksum(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as source:
+        for block in iter(lambda: source.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def normalize_column_name(column: str) -> str:
+    """`cleaned_data.csv` uses `CountryCode`/`Jan_80` where `kwerty_data.csv` uses `country_code`/`jan_80`."""
+    return re.sub(r"(?<=[a-z])(?=[A-Z])", "_", column.strip()).lower()
+
+
+def read_validation_csv(path: str) -> pandas.DataFrame:
+    frame = pandas.read_csv(path, encoding="utf-8", low_memory=False)
+    frame = frame.drop(columns=[column for column in frame.columns if column.startswith("Unnamed:")])
+    frame.columns = [normalize_column_name(column) for column in frame.columns]
+    return frame
+
+
+def encode_strings(strings):
+    encoded = [string.encode("utf-8") for string in strings]
+    offsets = numpy.zeros(len(encoded) + 1, dtype=numpy.int64)
+    numpy.cumsum([len(string) for string in encoded], out=offsets[1:])
+    return offsets, numpy.frombuffer(b"".join(encoded), dtype=numpy.uint8)
+
+
+def decode_strings(offsets, blob):
+    data = blob.tobytes()
+    return [data[start:end].decode("utf-8") for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist())]
+
+
+def store_arrays(store: ValidationStore) -> Dict[str, numpy.ndarray]:
+    arrays = {"keys": store.keys, "values": store.values, "derived_keys": store.derived_keys}
+    for name, column in store.metadata.items():
+        offsets, blob = encode_strings(column.categories)
+        arrays[f"{name}.codes"] = column.codes
+        arrays[f"{name}.offsets"] = offsets
+        arrays[f"{name}.strings"] = blob
+    for name, series in store.series.items():
+        arrays[f"series.{name}.keys"] = series.keys
+        arrays[f"series.{name}.values"] = series.values
+    # Mapped like the cells, so workers share it instead of each sorting its own copy at startup.
+    value_index = store.value_index
+    arrays["value_index.values"] = value_index.values
+    arrays["value_index.periods"] = value_index.periods
+    arrays["value_index.row_starts"] = numpy.asarray(value_index.row_starts, dtype=numpy.int64)
+    return arrays
+
+
+def write_snapshot(store: ValidationStore, path: str, source_checksum: str):
+    arrays = store_arrays(store)
+    descriptors = {}
+    offset = 0
+    for name, array in arrays.items():
+        descriptors[name] = {"dtype": array.dtype.str, "shape": list(array.shape), "offset": offset}
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    header = json.dumps(
+        {
+            "format_version": FORMAT_VERSION,
+            "source_checksum": source_checksum,
+            "version": store.version or source_checksum,
+            "periods": store.periods,
+            "metadata_columns": list(store.metadata),
+            "series": list(store.series),
+            "arrays": descriptors,
+        }
+    ).encode("utf-8")
+    preamble_length = len(MAGIC) + HEADER_LENGTH.size + len(header)
+    data_start = -(-preamble_length // ALIGNMENT) * ALIGNMENT
+
+    # Write next to the target and rename, so concurrent readers never see a partial snapshot.
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile("wb", dir=directory, delete=False) as snapshot:
+        snapshot.write(MAGIC)
+        snapshot.write(HEADER_LENGTH.pack(len(header)))
+        snapshot.write(header)
+        for name, array in arrays.items():
+            snapshot.seek(data_start + descriptors[name]["offset"])
+            snapshot.write(numpy.ascontiguousarray(array).tobytes())
+        snapshot.truncate(data_start + offset)
+    os.chmod(snapshot.name, 0o644)
+    os.replace(snapshot.name, path)
+
+
+def read_header(buffer):
+    if bytes(buffer[:len(MAGIC)]) != MAGIC:
+        raise SnapshotError("Not a kwerty dataset snapshot")
+    (header_length,) = HEADER_LENGTH.unpack_from(buffer, len(MAGIC))
+    header_start = len(MAGIC) + HEADER_LENGTH.size
+    header = json.loads(bytes(buffer[header_start:header_start + header_length]).decode("utf-8"))
+    data_start = -(-(header_start + header_length) // ALIGNMENT) * ALIGNMENT
+    return header, data_start
+
+
+def read_snapshot_header(path: str) -> dict:
+    with open(path, "rb") as snapshot:
+        preamble = snapshot.read(len(MAGIC) + HEADER_LENGTH.size)
+        if len(preamble) < len(MAGIC) + HEADER_LENGTH.size:
+            raise SnapshotError("Truncated snapshot")
+        (header_length,) = HEADER_LENGTH.unpack_from(preamble, len(MAGIC))
+        header, _ = read_header(preamble + snapshot.read(header_length))
+    return header
+
+
+def header_version(header: dict) -> str:
+    # Snapshots written before deltas could be merged in only record the source checksum.
+    return header.get("version") or header.get("source_checksum")
+
+
+def store_from_buffer(buffer, lazy_strings=False) -> ValidationStore:
+    header, data_start = read_header(buffer)
+    if header.get("format_version") != FORMAT_VERSION:
+        raise SnapshotError(f"Unsupported snapshot format version {header.get('format_version')}")
+
+    arrays = {}
+    for name, descriptor in header["arrays"].items():
+        dtype = numpy.dtype(descriptor["dtype"])
+        count = int(numpy.prod(descriptor["shape"], dtype=numpy.int64))
+        arrays[name] = numpy.frombuffer(
+            buffer, dtype=dtype, count=count, offset=data_start + descriptor["offset"]
+        ).reshape(descriptor["shape"])
+
+    metadata = {}
+    for name in header["metadata_columns"]:
+        offsets, blob = arrays[f"{name}.offsets"], arrays[f"{name}.strings"]
+        metadata[name] = StringColumn(
+            codes=arrays[f"{name}.codes"],
+            categories=StringTable(offsets, blob) if lazy_strings else decode_strings(offsets, blob),
+        )
+    store = ValidationStore(
+        metadata=metadata,
+        periods=header["periods"],
+        keys=arrays["keys"],
+        values=arrays["values"],
+        version=header_version(header),
+        source_checksum=header["source_checksum"],
+        derived_keys=arrays["derived_keys"],
+        series={
+            name: CellSeries(keys=arrays[f"series.{name}.keys"], values=arrays[f"series.{name}.values"])
+            for name in header["series"]
+        },
+    )
+    store.value_index = ValueIndex(
+        values=arrays["value_index.values"],
+        periods=arrays["value_index.periods"],
+        row_starts=arrays["value_index.row_starts"],
+    )
+    return store
+
+
+def load_snapshot(path: str, memory_map: bool = False) -> ValidationStore:
+    """
+    With `memory_map` the arrays and string tables are views over a read-only mapping of the file,
+    so every worker process on the host shares the same page cache copy instead of holding its own.
+    """
+    with open(path, "rb") as snapshot:
+        if not memory_map:
+            store = store_from_buffer(snapshot.read())
+            store.snapshot_path = path
+            return store
+        mapping = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+    store = store_from_buffer(mapping, lazy_strings=True)
+    store.memory_mapped = True
+    store.snapshot_path = path
+    return store
+
+
+def build_store(source: str) -> ValidationStore:
+    checksum = file_checksum(source)
+    store = ValidationStore.from_frame(read_validation_csv(source)).with_derived_periods().with_derived_series()
+    store.version = store.source_checksum = checksum
+    return store
+
+
+def build_snapshot(source: str, output: str) -> ValidationStore:
+    store = build_store(source)
+    write_snapshot(store, output, store.source_checksum)
+    return store
+
+
+def snapshot_is_stale(source: str, output: str) -> Optional[str]:
+    """Returns why the snapshot has to be rebuilt, or None when it is up to date."""
+    if not os.path.exists(output):
+        return "missing"
+    try:
+        header = read_snapshot_header(output)
+    except (SnapshotError, ValueError) as error:
+        return f"unreadable ({error})"
+    if header.get("format_version") != FORMAT_VERSION:
+        return f"format version {header.get('format_version')} != {FORMAT_VERSION}"
+    if os.path.exists(source) and header.get("source_checksum") != file_checksum(source):
+        return f"checksum mismatch with {source}"
+    return None
+
+
+def load_dataset(
+        source: str = VALIDATION_DATA_PATH,
+        output: str = VALIDATION_SNAPSHOT_PATH,
+        memory_map: bool = MEMORY_MAP_VALIDATION_DATA,
+) -> ValidationStore:
+    """
+    Load the snapshot, rebuilding it first if it is missing or stale. When only the snapshot
+    is deployed (no CSV next to it) it is used as is.
+
+    On a read-only filesystem (e.g. Vercel) the snapshot is written to the temp directory instead,
+    and when that fails too the store is served from memory as built from the CSV.
+    """
+    if not snapshot_is_stale(source, output):
+        return load_snapshot(output, memory_map=memory_map)
+    if not os.path.exists(source):
+        raise SnapshotError(f"Neither a usable snapshot {output} nor the source {source} exists")
+    fallback = os.path.join(tempfile.gettempdir(), os.path.basename(output))
+    if os.path.abspath(fallback) != os.path.abspath(output) and not snapshot_is_stale(source, fallback):
+        return load_snapshot(fallback, memory_map=memory_map)
+    store = build_store(source)
+    for path in (output, fallback):
+        try:
+            write_snapshot(store, path, store.source_checksum)
+        except OSError as error:
+            logging.warning("Could not write the snapshot %s: %s", path, error)
+            continue
+        return load_snapshot(path, memory_map=memory_map)
+    return store
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build the binary validation dataset snapshot.")
+    parser.add_argument("command", choices=["build", "check"])
+    parser.add_argument("--source", default=VALIDATION_DATA_PATH)
+    parser.add_argument("--output", default=VALIDATION_SNAPSHOT_PATH)
+    args = parser.parse_args(argv)
+
+    if args.command == "check":
+        reason = snapshot_is_stale(args.source, args.output)
+        if reason:
+            print(f"{args.output} is stale: {reason}")
+            return 1
+        print(f"{args.output} is up to date")
+        return 0
+
+    store = build_snapshot(args.source, args.output)
+    print(
+        f"Wrote {args.output}: {store.row_count} rows, {len(store.periods)} periods, "
+        f"{len(store.keys)} cells, version {store.version[:12]}"
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
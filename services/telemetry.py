@@ -0,0 +1,180 @@
+"""
+Request telemetry in the Prometheus text exposition format, served on `/kwerty/metrics/`.
+
+Metrics are kept per worker process, like `CACHE_STATS`; with several workers, each is scraped
+as its own target. Recording a sample is a lock plus a bisect, so the stages can be timed on
+every request.
+"""
+import bisect
+import contextlib
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List, Sequence, Tuple
+
+from services.cache_keys import CACHE_STATS
+from services.profiling import span
+
+# Starlette appends the charset to text responses.
+CONTENT_TYPE = "text/plain; version=0.0.4"
+# Seconds; the stages range from sub-millisecond lookups to LLM calls of tens of seconds.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names: Sequence[str], values: Tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values: Dict[Tuple, float] = defaultdict(float)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        with self.lock:
+            self.values[key] += amount
+
+    def render(self) -> List[str]:
+        with self.lock:
+            values = sorted(self.values.items())
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        lines.extend(f"{self.name}{format_labels(self.labels, key)} {format_number(value)}" for key, value in values)
+        return lines
+
+
+class Histogram:
+    def __init__(
+            self, name: str, documentation: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        # Per label set: the count of each bucket (not cumulative, the last one is +Inf) and the sum.
+        self.counts: Dict[Tuple, List[int]] = {}
+        self.sums: Dict[Tuple, float] = defaultdict(float)
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(name, "") for name in self.labels)
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.counts.get(key)
+            if counts is None:
+                counts = self.counts[key] = [0] * (len(self.buckets) + 1)
+            counts[bucket] += 1
+            self.sums[key] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observe the duration of the `with` block, also when it raises."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self) -> List[str]:
+        with self.lock:
+            series = sorted((key, list(counts), self.sums[key]) for key, counts in self.counts.items())
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                bucket_labels = format_labels(self.labels, key, f'le="{format_number(float(bound))}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {format_number(total)}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+STAGE_SECONDS = Histogram(
+    "kwerty_stage_duration_seconds",
+    "Time spent in each stage of evaluating a text.",
+    labels=("stage",),
+)
+REQUEST_SECONDS = Histogram(
+    "kwerty_request_duration_seconds",
+    "Time to answer a request, by route.",
+    labels=("method", "route", "status"),
+)
+LLM_TOKENS = Counter("kwerty_llm_tokens_total", "Tokens used by LLM extractions.", labels=("kind",))
+LLM_REQUESTS = Counter("kwerty_llm_requests_total", "LLM extractions, by outcome.", labels=("outcome",))
+VALIDATED_METRICS = Counter(
+    "kwerty_validated_metrics_total",
+    "Metrics checked against the validation data, by invalidity reason (none when valid).",
+    labels=("reason",),
+)
+EXTRACTION_ERRORS = Counter(
+    "kwerty_extraction_errors_total", "Country entries that could not be validated, by reason.", labels=("reason",)
+)
+METRICS = (STAGE_SECONDS, REQUEST_SECONDS, LLM_TOKENS, LLM_REQUESTS, VALIDATED_METRICS, EXTRACTION_ERRORS)
+
+
+@contextlib.contextmanager
+def stage(name: str, **attributes):
+    """Observe the `with` block in STAGE_SECONDS and, when the request is profiled, record it as a span."""
+    with STAGE_SECONDS.time(stage=name), span(name, **attributes):
+        yield
+
+
+class RequestTimer:
+    """
+    ASGI middleware observing REQUEST_SECONDS per endpoint. It times until the last chunk of the
+    body is sent, so streamed responses count in full.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        status = 500
+
+        async def send_and_record_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_and_record_status)
+        finally:
+            # The router stores the matched endpoint in the scope; its name keeps the label set small.
+            route = getattr(scope.get("endpoint"), "__name__", "unmatched")
+            REQUEST_SECONDS.observe(time.perf_counter() - started, method=scope["method"], route=route, status=status)
+
+
+def render_cache_stats() -> List[str]:
+    name = "kwerty_cache_lookups_total"
+    lines = [f"# HELP {name} Cache lookups per cache layer, by result.", f"# TYPE {name} counter"]
+    for layer, counts in sorted(CACHE_STATS.snapshot().items()):
+        for result, count in (("hit", counts["hits"]), ("miss", counts["misses"])):
+            lines.append(f"{name}{format_labels(('layer', 'result'), (layer, result))} {count}")
+    return lines
+
+
+def render() -> str:
+    lines = [line for metric in METRICS for line in metric.render()]
+    lines.extend(render_cache_stats())
+    return "\n".join(lines) + "\n"
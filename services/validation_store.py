@@ -0,0 +1,569 @@
+import dataclasses
+import functools
+from collections import defaultdict
+from collections.abc import Sequence as SequenceABC
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy
+import pandas
+
+from services.periods import Period, PeriodAxis
+
+METADATA_COLUMNS = (
+    "country",
+    "indicator",
+    "source",
+    "link",
+    "currency_code",
+    "unit",
+    "category",
+    "frequency",
+    "country_code",
+    "indicator_definition",
+    "note",
+    "tag",
+)
+# Cells are addressed by a single int64 key: the row in the high bits, the period in the low bits.
+# Rows and periods can therefore be appended without re-keying the existing cells.
+PERIOD_BITS = 16
+PERIOD_MASK = (1 << PERIOD_BITS) - 1
+# Derived series: percent change against the period of the same length `lag` months earlier, for
+# the period lengths (in months) listed, and trailing averages over `window` months.
+GROWTH_SERIES = {"yoy": (12, (1, 3, 12)), "qoq": (3, (3,)), "mom": (1, (1,))}
+ROLLING_SERIES = {"avg3m": 3}
+
+
+def cell_keys(rows, periods):
+    return (numpy.asarray(rows, dtype=numpy.int64) << PERIOD_BITS) | numpy.asarray(periods, dtype=numpy.int64)
+
+
+def gather_cells(cell_keys_: numpy.ndarray, values: numpy.ndarray, rows, periods) -> numpy.ndarray:
+    """Gather the cells at (rows[i], periods[i]) from sorted keys; missing cells come back as NaN."""
+    keys = cell_keys(rows, periods)
+    if not len(cell_keys_):
+        return numpy.full(len(keys), numpy.nan, dtype=numpy.float32)
+    positions = numpy.minimum(numpy.searchsorted(cell_keys_, keys), len(cell_keys_) - 1)
+    found = cell_keys_[positions] == keys
+    return numpy.where(found, values[positions], numpy.float32(numpy.nan))
+
+
+def contains_cells(cell_keys_: numpy.ndarray, keys: numpy.ndarray) -> numpy.ndarray:
+    """Which of `keys` are in the sorted `cell_keys_`."""
+    if not len(cell_keys_):
+        return numpy.zeros(len(keys), dtype=bool)
+    positions = numpy.minimum(numpy.searchsorted(cell_keys_, keys), len(cell_keys_) - 1)
+    return cell_keys_[positions] == keys
+
+
+def value_order(rows: numpy.ndarray, values: numpy.ndarray) -> numpy.ndarray:
+    """uint64 keys that sort like (row, value): the row in the high bits, the float32 bits made monotonic below."""
+    bits = values.astype(numpy.float32).view(numpy.uint32).astype(numpy.uint64)
+    bits = numpy.where(bits & 0x80000000, ~bits & 0xFFFFFFFF, bits | 0x80000000)
+    return (rows.astype(numpy.uint64) << numpy.uint64(32)) | bits
+
+
+def merge_cells(cell_keys_: numpy.ndarray, values: numpy.ndarray, new_keys: numpy.ndarray, new_values: numpy.ndarray):
+    """Insert cells into sorted keys without re-sorting them; the new keys must not be present yet."""
+    order = numpy.argsort(new_keys, kind="stable")
+    positions = numpy.searchsorted(cell_keys_, new_keys[order])
+    return numpy.insert(cell_keys_, positions, new_keys[order]), numpy.insert(values, positions, new_values[order])
+
+
+def parse_numeric(column: pandas.Series) -> numpy.ndarray:
+    """Cells may hold strings such as '  1,064 ', so clean them up before converting."""
+    if column.dtype == object:
+        column = pandas.to_numeric(
+            column.astype(str).str.replace(",", "", regex=False).str.strip(), errors="coerce"
+        )
+    return column.to_numpy(dtype=numpy.float32, na_value=numpy.nan)
+
+
+def format_value(value) -> Optional[float]:
+    """Turn a stored float32 back into the shortest float that round-trips, e.g. 5.6 not 5.599999."""
+    if value is None or numpy.isnan(value):
+        return None
+    return float(numpy.format_float_positional(numpy.float32(value)))
+
+
+def same_value(stored: Optional[float], claimed) -> bool:
+    """Compare a stored cell with a claimed value at the float32 precision the cells are kept in."""
+    if stored is None or claimed is None:
+        return False
+    try:
+        claimed = float(str(claimed).replace(",", "").strip())
+    except ValueError:
+        return False
+    return numpy.float32(claimed) == numpy.float32(stored)
+
+
+class StringTable(SequenceABC):
+    """
+    Read-only string list stored as utf-8 bytes plus offsets. Strings are decoded on access so
+    the table can live in a memory-mapped snapshot without being copied into each process.
+    """
+
+    def __init__(self, offsets: numpy.ndarray, blob: numpy.ndarray):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[position] for position in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self.blob[self.offsets[index]:self.offsets[index + 1]].tobytes().decode("utf-8")
+
+
+@dataclasses.dataclass
+class StringColumn:
+    """Dictionary encoded metadata column; a code of -1 marks a missing value."""
+
+    codes: numpy.ndarray
+    categories: Sequence[str]
+
+    @classmethod
+    def from_series(cls, series: pandas.Series):
+        categorical = pandas.Categorical(series)
+        return cls(
+            codes=categorical.codes.astype(numpy.int32),
+            categories=categorical.categories.astype(str).to_list(),
+        )
+
+    def __getitem__(self, row) -> Optional[str]:
+        code = self.codes[row]
+        if code < 0:
+            return None
+        return self.categories[code]
+
+    def __len__(self):
+        return len(self.codes)
+
+    def appended(self, values: Sequence[Optional[str]]) -> "StringColumn":
+        """A column with `values` appended as new rows; unseen values are added to the categories."""
+        categories = list(self.categories)
+        lookup = {category: code for code, category in enumerate(categories)}
+        codes = []
+        for value in values:
+            if value is not None and value not in lookup:
+                lookup[value] = len(categories)
+                categories.append(value)
+            codes.append(-1 if value is None else lookup[value])
+        return StringColumn(
+            codes=numpy.concatenate([self.codes, numpy.asarray(codes, dtype=numpy.int32)]), categories=categories
+        )
+
+    def to_list(self) -> List[Optional[str]]:
+        return [self[row] for row in range(len(self))]
+
+
+@dataclasses.dataclass
+class CellSeries:
+    """A derived series in the same sparse layout as the base cells: sorted int64 keys, float32 values."""
+
+    keys: numpy.ndarray
+    values: numpy.ndarray
+
+    def lookup(self, rows, periods) -> numpy.ndarray:
+        return gather_cells(self.keys, self.values, rows, periods)
+
+
+class ValueIndex:
+    """
+    The cells of each row sorted by value, so the periods of a row holding (roughly) a given value
+    are found with a binary search instead of a scan over the row.
+    """
+
+    def __init__(self, values: numpy.ndarray, periods: numpy.ndarray, row_starts: numpy.ndarray):
+        self.values = values
+        self.periods = periods
+        self.row_starts = row_starts
+
+    @classmethod
+    def from_cells(cls, keys: numpy.ndarray, values: numpy.ndarray, row_count: int):
+        rows = keys >> PERIOD_BITS
+        order = numpy.lexsort((values, rows))
+        return cls(
+            values=values[order],
+            periods=(keys[order] & PERIOD_MASK).astype(numpy.int32),
+            row_starts=numpy.searchsorted(rows[order], numpy.arange(row_count + 1)),
+        )
+
+    def with_cells(self, keep: numpy.ndarray, keys: numpy.ndarray, values: numpy.ndarray, row_count: int) -> "ValueIndex":
+        """
+        The index with only the entries in `keep` left and the cells `keys`/`values` added, for a
+        store of `row_count` rows. Each added cell is inserted at its place in its row's segment,
+        so nothing already indexed is sorted again.
+        """
+        indexed_rows = len(self.row_starts) - 1
+        old_rows = numpy.repeat(numpy.arange(indexed_rows), numpy.diff(self.row_starts))[keep]
+        old_values, old_periods = self.values[keep], self.periods[keep]
+        new_rows = keys >> PERIOD_BITS
+        order = numpy.lexsort((values, new_rows))
+        new_rows, new_values = new_rows[order], values[order]
+        new_periods = (keys[order] & PERIOD_MASK).astype(numpy.int32)
+        positions = numpy.searchsorted(
+            value_order(old_rows, old_values), value_order(new_rows, new_values), side="right"
+        )
+        rows = numpy.insert(old_rows, positions, new_rows)
+        return ValueIndex(
+            values=numpy.insert(old_values, positions, new_values),
+            periods=numpy.insert(old_periods, positions, new_periods),
+            row_starts=numpy.searchsorted(rows, numpy.arange(row_count + 1)),
+        )
+
+    def periods_near(self, row: int, value: float, tolerance: float = 0) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """Period ids and values of the cells of `row` within `tolerance` of `value`."""
+        start, end = self.row_starts[row], self.row_starts[row + 1]
+        segment = self.values[start:end]
+        # Bounds are rounded to float32 like the cells, so a tolerance of 0 is float32 equality.
+        low = numpy.searchsorted(segment, numpy.float32(value - tolerance), side="left")
+        high = numpy.searchsorted(segment, numpy.float32(value + tolerance), side="right")
+        return self.periods[start + low:start + high], segment[low:high]
+
+
+class RowView:
+    """
+    Read-only view of one row of a `ValidationStore`. Nothing is copied up front; a field is read
+    from its column, or a period cell gathered, only when it is asked for.
+    """
+
+    __slots__ = ("store", "row")
+
+    def __init__(self, store: "ValidationStore", row: int):
+        self.store = store
+        self.row = row
+
+    def __getitem__(self, column: str):
+        if column in self.store.metadata:
+            return self.store.metadata[column][self.row]
+        if column in self.store.period_index:
+            return self.store.value(self.row, column)
+        raise KeyError(column)
+
+    def get(self, column: str, default=None):
+        try:
+            return self[column]
+        except KeyError:
+            return default
+
+    def project(self, columns: Sequence[str], period: str = None, series: str = None) -> Dict:
+        """
+        The given metadata columns plus the cell of `period` (in `series` when given) as "value",
+        the period and the series; missing fields are None.
+        """
+        projected = {column: self.store.metadata[column][self.row] for column in columns}
+        projected["value"] = self.store.value(self.row, period, series) if period else None
+        projected["period"] = period
+        projected["series"] = series
+        return projected
+
+
+class ValidationStore:
+    """
+    Compact in-memory form of the validation dataset. Row metadata is kept as dictionary encoded
+    columns and the period cells as a sparse list of (row, period) keys with float32 values, sorted
+    by key so a cell lookup is a binary search instead of a scan over a wide DataFrame.
+    """
+
+    def __init__(
+            self,
+            metadata: Dict[str, StringColumn],
+            periods: List[str],
+            keys: numpy.ndarray,
+            values: numpy.ndarray,
+            version: str = None,
+            derived_keys: numpy.ndarray = None,
+            series: Dict[str, CellSeries] = None,
+            source_checksum: str = None,
+    ):
+        self.version = version
+        # Checksum of the CSV the store was built from; the version differs once deltas are merged in.
+        self.source_checksum = source_checksum or version
+        self.memory_mapped = False
+        # The snapshot file the store was loaded from; None for a store built or merged in memory.
+        self.snapshot_path = None
+        self.metadata = metadata
+        self.periods = periods
+        # Sorted keys of the cells that are averages computed from the monthly data, not source values.
+        self.derived_keys = numpy.zeros(0, dtype=numpy.int64) if derived_keys is None else derived_keys
+        self.series = series or {}
+        self.period_index = {period: index for index, period in enumerate(periods)}
+        self.keys = keys
+        self.values = values
+
+    @classmethod
+    def from_frame(cls, frame: pandas.DataFrame):
+        metadata = {column: StringColumn.from_series(frame[column]) for column in METADATA_COLUMNS}
+        periods = [column for column in frame.columns if column not in METADATA_COLUMNS]
+        dense = numpy.column_stack([parse_numeric(frame[period]) for period in periods])
+        rows, period_ids = numpy.nonzero(~numpy.isnan(dense))
+        # numpy.nonzero walks the matrix in row-major order, so the keys come out sorted.
+        return cls(
+            metadata=metadata,
+            periods=periods,
+            keys=cell_keys(rows, period_ids),
+            values=dense[rows, period_ids],
+        )
+
+    def with_derived_periods(self, since: numpy.ndarray = None) -> "ValidationStore":
+        """
+        A store with annual and quarterly averages of complete monthly data added, for the cells of
+        each row whose year or quarter has no value of its own, whether or not that period has a
+        column. The averages are computed here once, vectorized over all rows, so answering a claim
+        about a year never aggregates months per request. With `since` (see `cells_since`, aligned
+        to whole years), only the averages from there on are recomputed and the others are kept.
+        """
+        stale = contains_cells(self.derived_keys, self.keys)
+        kept_derived = self.derived_keys
+        if since is not None:
+            stale &= self.cells_since(self.keys, since)
+            kept_derived = kept_derived[~self.cells_since(kept_derived, since)]
+        base_keys, base_values = self.keys[~stale], self.values[~stale]
+        in_scope = slice(None) if since is None else self.cells_since(base_keys, since)
+        cell_rows = base_keys[in_scope] >> PERIOD_BITS
+        period_ids = base_keys[in_scope] & PERIOD_MASK
+        monthly = self.period_axis.months[period_ids] == 1
+        monthly_rows = cell_rows[monthly]
+        monthly_starts = self.period_axis.starts[period_ids[monthly]].astype(numpy.int64)
+        monthly_values = base_values[in_scope][monthly].astype(numpy.float64)
+
+        periods = list(self.periods)
+        period_index = dict(self.period_index)
+        keys, values = [], []
+        for months in (12, 3):
+            group_starts = monthly_starts - monthly_starts % months
+            groups, inverse, counts = numpy.unique(
+                cell_keys(monthly_rows, group_starts), return_inverse=True, return_counts=True
+            )
+            complete = counts == months
+            averages = (numpy.bincount(inverse, weights=monthly_values)[complete] / months).astype(numpy.float32)
+            starts, start_inverse = numpy.unique(groups[complete] & PERIOD_MASK, return_inverse=True)
+
+            start_ids = []
+            for start in starts.tolist():
+                name = Period(start=start, months=months).name
+                if name not in period_index:
+                    period_index[name] = len(periods)
+                    periods.append(name)
+                start_ids.append(period_index[name])
+            group_ids = numpy.asarray(start_ids, dtype=numpy.int64)[start_inverse]
+            group_keys = cell_keys(groups[complete] >> PERIOD_BITS, group_ids)
+            # A value of the row's own for the year or quarter is kept, the average only fills the gap.
+            keep = ~contains_cells(base_keys, group_keys)
+            keys.append(group_keys[keep])
+            values.append(averages[keep])
+
+        derived_keys, derived_values = numpy.concatenate(keys), numpy.concatenate(values)
+        keys, values = merge_cells(base_keys, base_values, derived_keys, derived_values)
+        store = ValidationStore(
+            metadata=self.metadata,
+            periods=periods,
+            keys=keys,
+            values=values,
+            version=self.version,
+            source_checksum=self.source_checksum,
+            derived_keys=numpy.union1d(kept_derived, derived_keys),
+            series=self.series,
+        )
+        store.period_axis = self.period_axis.extended(periods[len(self.periods):])
+        return store
+
+    def with_derived_series(self, since: numpy.ndarray = None) -> "ValidationStore":
+        """
+        A store with the GROWTH_SERIES and ROLLING_SERIES of every indicator precomputed over the
+        period axis, so a claimed growth rate or average is checked with one lookup. With `since`
+        (see `cells_since`), only the series cells from there on are recomputed; a series cell only
+        depends on earlier cells of its row, so the others are still up to date.
+        """
+        in_scope = slice(None) if since is None else self.cells_since(self.keys, since)
+        scope_keys = self.keys[in_scope]
+        cell_rows = scope_keys >> PERIOD_BITS
+        period_ids = scope_keys & PERIOD_MASK
+        values = self.values[in_scope].astype(numpy.float64)
+        series = {}
+        for name, (lag, lengths) in GROWTH_SERIES.items():
+            earlier_ids = self.period_axis.shifted(lag, lengths)[period_ids]
+            earlier = numpy.full(len(scope_keys), numpy.nan)
+            has_earlier = earlier_ids >= 0
+            earlier[has_earlier] = self.lookup(cell_rows[has_earlier], earlier_ids[has_earlier])
+            usable = ~numpy.isnan(earlier) & (earlier != 0)
+            growth = (values[usable] / earlier[usable] - 1) * 100
+            # A subset of sorted keys is still sorted.
+            series[name] = CellSeries(keys=scope_keys[usable], values=growth.astype(numpy.float32))
+
+        monthly = self.period_axis.months[period_ids] == 1
+        for name, window in ROLLING_SERIES.items():
+            total, complete = values.copy(), monthly.copy()
+            for lag in range(1, window):
+                earlier_ids = self.period_axis.shifted(lag, (1,))[period_ids]
+                earlier = numpy.full(len(scope_keys), numpy.nan)
+                has_earlier = complete & (earlier_ids >= 0)
+                earlier[has_earlier] = self.lookup(cell_rows[has_earlier], earlier_ids[has_earlier])
+                complete &= ~numpy.isnan(earlier)
+                total += numpy.nan_to_num(earlier)
+            series[name] = CellSeries(keys=scope_keys[complete], values=(total[complete] / window).astype(numpy.float32))
+
+        if since is not None:
+            for name, cells in series.items():
+                previous = self.series[name]
+                keep = ~self.cells_since(previous.keys, since)
+                merged = merge_cells(previous.keys[keep], previous.values[keep], cells.keys, cells.values)
+                series[name] = CellSeries(*merged)
+
+        store = ValidationStore(
+            metadata=self.metadata,
+            periods=self.periods,
+            keys=self.keys,
+            values=self.values,
+            version=self.version,
+            source_checksum=self.source_checksum,
+            derived_keys=self.derived_keys,
+            series=series,
+        )
+        store.period_axis = self.period_axis
+        return store
+
+    def with_delta(self, frame: pandas.DataFrame) -> "ValidationStore":
+        """
+        A store with a delta release merged in. The delta has the layout of the CSV and holds only
+        the changed rows, usually all columns of a new month. Rows are matched on all metadata
+        columns: every matching row gets the delta's non-empty cells, and rows that match none are
+        appended. Unknown period columns are appended to the axis. A delta value for a cell that
+        held an average replaces it. The derived averages, series and value index are only
+        recomputed from the first changed year of each row on, so the cost grows with the delta,
+        not with the dataset.
+        """
+        missing = [column for column in METADATA_COLUMNS if column not in frame.columns]
+        if missing:
+            raise ValueError(f"The delta has no {', '.join(missing)} column")
+        periods = [column for column in frame.columns if column not in METADATA_COLUMNS]
+
+        # Rows are matched on their metadata codes; a value without a code yet can only be a new row.
+        codes = {
+            column: {category: code for code, category in enumerate(self.metadata[column].categories)}
+            for column in METADATA_COLUMNS
+        }
+        existing = defaultdict(list)
+        stored = numpy.column_stack([self.metadata[column].codes for column in METADATA_COLUMNS])
+        for row, identity in enumerate(map(tuple, stored.tolist())):
+            existing[identity].append(row)
+        identities = zip(*(
+            [None if empty else str(value) for value, empty in zip(frame[column].tolist(), frame[column].isna().tolist())]
+            for column in METADATA_COLUMNS
+        ))
+        added, targets = {}, []
+        for identity in identities:
+            coded = tuple(
+                -1 if value is None else codes[column].get(value, -2) for column, value in zip(METADATA_COLUMNS, identity)
+            )
+            rows = existing.get(coded)
+            if not rows:
+                rows = added.setdefault(identity, [self.row_count + len(added)])
+            targets.append(rows)
+
+        new_periods = dict.fromkeys(period for period in periods if period not in self.period_index)
+        all_periods = list(self.periods) + list(new_periods)
+        period_index = {period: index for index, period in enumerate(all_periods)}
+        # Only the non-empty cells are parsed; a delta is mostly empty.
+        cells = frame[periods]
+        positions, columns = numpy.nonzero(cells.notna().to_numpy())
+        cell_values = parse_numeric(pandas.Series(cells.to_numpy(dtype=object)[positions, columns]))
+        parsed = ~numpy.isnan(cell_values)
+        positions, columns, cell_values = positions[parsed], columns[parsed], cell_values[parsed]
+        # A delta row matching several (duplicate) rows updates all of them.
+        lengths = numpy.asarray([len(rows) for rows in targets], dtype=numpy.int64)[positions]
+        firsts = numpy.concatenate([[0], numpy.cumsum([len(rows) for rows in targets])])[positions]
+        target_rows = numpy.asarray([row for rows in targets for row in rows], dtype=numpy.int64)
+        cell_owners = numpy.repeat(numpy.arange(len(positions)), lengths)
+        offsets = numpy.arange(len(cell_owners)) - numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+        column_ids = numpy.asarray([period_index[period] for period in periods], dtype=numpy.int64)
+        delta_keys = cell_keys(target_rows[firsts[cell_owners] + offsets], column_ids[columns][cell_owners])
+        delta_values = cell_values[cell_owners]
+        # A cell given twice takes the later value.
+        delta_keys, last = numpy.unique(delta_keys[::-1], return_index=True)
+        delta_values = delta_values[::-1][last]
+
+        found = numpy.minimum(numpy.searchsorted(self.keys, delta_keys), max(len(self.keys) - 1, 0))
+        present = self.keys[found] == delta_keys if len(self.keys) else numpy.zeros(len(delta_keys), dtype=bool)
+        changed = ~present
+        changed[present] = self.values[found[present]] != delta_values[present]
+        keys, values = self.keys, self.values.copy()
+        values[found[present]] = delta_values[present]
+        keys, values = merge_cells(keys, values, delta_keys[~present], delta_values[~present])
+
+        metadata = self.metadata
+        if added:
+            metadata = {
+                column: self.metadata[column].appended([identity[position] for identity in added])
+                for position, column in enumerate(METADATA_COLUMNS)
+            }
+        store = ValidationStore(
+            metadata=metadata,
+            periods=all_periods,
+            keys=keys,
+            values=values,
+            version=self.version,
+            source_checksum=self.source_checksum,
+            derived_keys=self.derived_keys[~contains_cells(delta_keys, self.derived_keys)],
+            series=self.series,
+        )
+        store.period_axis = self.period_axis.extended(all_periods[len(self.periods):])
+
+        # Per row, the start of the year of its first changed cell; later derived cells may change.
+        since = numpy.full(store.row_count, numpy.iinfo(numpy.int64).max, dtype=numpy.int64)
+        changed_starts = store.period_axis.starts[delta_keys[changed] & PERIOD_MASK].astype(numpy.int64)
+        numpy.minimum.at(since, delta_keys[changed] >> PERIOD_BITS, changed_starts - changed_starts % 12)
+        store = store.with_derived_periods(since).with_derived_series(since)
+        indexed = self.value_index
+        indexed_rows = numpy.repeat(numpy.arange(self.row_count), numpy.diff(indexed.row_starts))
+        keep = ~self.cells_since(cell_keys(indexed_rows, indexed.periods), since)
+        refreshed = store.cells_since(store.keys, since)
+        store.value_index = indexed.with_cells(keep, store.keys[refreshed], store.values[refreshed], store.row_count)
+        return store
+
+    def cells_since(self, cell_keys_: numpy.ndarray, since: numpy.ndarray) -> numpy.ndarray:
+        """Which of the cells lie in a period starting in or after month `since[row]` of their row."""
+        return self.period_axis.starts[cell_keys_ & PERIOD_MASK] >= since[cell_keys_ >> PERIOD_BITS]
+
+    @functools.cached_property
+    def period_axis(self) -> PeriodAxis:
+        return PeriodAxis(self.periods)
+
+    @property
+    def row_count(self) -> int:
+        return len(self.metadata["country"])
+
+    @functools.cached_property
+    def columns(self):
+        return frozenset(METADATA_COLUMNS) | frozenset(self.periods)
+
+    @functools.cached_property
+    def value_index(self) -> ValueIndex:
+        return ValueIndex.from_cells(self.keys, self.values, self.row_count)
+
+    def column(self, name: str) -> StringColumn:
+        return self.metadata[name]
+
+    def lookup(self, rows, periods) -> numpy.ndarray:
+        """Gather the cells at (rows[i], periods[i]); missing cells come back as NaN."""
+        return gather_cells(self.keys, self.values, rows, periods)
+
+    def is_derived(self, rows, periods) -> numpy.ndarray:
+        """Which of the cells at (rows[i], periods[i]) are averages computed from the monthly data."""
+        return contains_cells(self.derived_keys, cell_keys(rows, periods))
+
+    def value(self, row: int, period: str, series: str = None) -> Optional[float]:
+        """A cell, or with `series` the cell of that derived series, e.g. "yoy"."""
+        period_id = self.period_index.get(period)
+        if period_id is None:
+            return None
+        cells = self.series[series] if series else self
+        return format_value(cells.lookup([row], [period_id])[0])
+
+    def row(self, row: int) -> RowView:
+        return RowView(self, row)
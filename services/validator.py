@@ -0,0 +1,164 @@
+import dataclasses
+import re
+from typing import List, Optional, Sequence
+
+import numpy
+
+from config import ACCEPT_INFERRED_PERIODS, SERIES_KEYWORDS, VALUE_ROUNDING_TOLERANCE
+from services.number_scanner import parse_number
+from services.validation_store import ValidationStore
+
+
+@dataclasses.dataclass
+class Claim:
+    """A claimed value for a period, to be checked against candidate rows in order of preference."""
+    rows: Optional[Sequence[int]]
+    period: Optional[str]
+    value: Optional[str]
+    # Why `period` is unknown (MONTH_MISSING or YEAR_MISSING); the period is then looked up by value,
+    # among `allowed_periods` when given (e.g. the months of the claimed year).
+    missing: Optional[str] = None
+    allowed_periods: Optional[Sequence[str]] = None
+    # Derived series ("yoy", "mom", ...) the value may be stated in, e.g. for "grew 3.1% year-on-year".
+    series: Optional[str] = None
+
+
+@dataclasses.dataclass
+class ValidationResult:
+    """
+    One entry per claim. `rows` holds the row a claim was checked against: the first candidate
+    holding the claimed value, else the last candidate with a cell for the period, else -1.
+    `periods` is the claimed period, or the one found by value. `series` is the derived series
+    a valid claim matched in, or None for the stored cell. `reasons` is None for valid claims,
+    else INVALID_METRIC (a candidate has a cell for the period, but not the claimed value),
+    INSUFFICIENT_DATA (no candidate or no cell for the period), PERIOD_INFERRED (a period was
+    found by value but the claim does not state it) or the claim's missing reason.
+    """
+    is_valid: numpy.ndarray
+    rows: numpy.ndarray
+    periods: List[Optional[str]]
+    series: List[Optional[str]]
+    reasons: List[Optional[str]]
+
+
+SERIES_PATTERNS = {
+    name: re.compile(r"\b(?:" + "|".join(re.escape(keyword) for keyword in keywords) + r")(?!\w)", re.IGNORECASE)
+    for name, keywords in SERIES_KEYWORDS.items()
+}
+
+
+def detect_series(text: str) -> Optional[str]:
+    """The derived series a claim's wording refers to, if any."""
+    for name, pattern in SERIES_PATTERNS.items():
+        if text and pattern.search(text):
+            return name
+    return None
+
+
+def rounding_tolerance(value) -> float:
+    """Half a unit (by default) in the last digit of the claimed value as written."""
+    digits = str(value).replace(",", "").strip().rstrip("%").strip()
+    decimals = len(digits.partition(".")[2])
+    return VALUE_ROUNDING_TOLERANCE * 10 ** -decimals
+
+
+class Validator:
+    """Checks all claims of a country with a single gather over the stored cells."""
+
+    def __init__(self, validation_data: ValidationStore):
+        self.validation_data = validation_data
+
+    def validate(self, claims: Sequence[Claim]) -> ValidationResult:
+        count = len(claims)
+        lengths = numpy.array([len(claim.rows or ()) for claim in claims], dtype=numpy.int64)
+        period_ids = numpy.array(
+            [self.validation_data.period_index.get(claim.period, -1) for claim in claims], dtype=numpy.int64
+        )
+        # None (unparsable claims) becomes NaN.
+        claimed = numpy.array([parse_number(claim.value) for claim in claims], dtype=numpy.float64).astype(numpy.float32)
+
+        # Flatten every candidate row of every claim into one gather.
+        rows = numpy.array([row for claim in claims for row in claim.rows or ()], dtype=numpy.int64)
+        owners = numpy.repeat(numpy.arange(count), lengths)
+        periods = period_ids[owners]
+        cells = numpy.full(len(rows), numpy.nan, dtype=numpy.float32)
+        known = periods >= 0
+        if known.any():
+            cells[known] = self.validation_data.lookup(rows[known], periods[known])
+        # NaN never equals anything, so missing cells and unparsable claims are not matches.
+        equal = cells == claimed[owners]
+        tolerances = numpy.array([rounding_tolerance(claim.value) for claim in claims], dtype=numpy.float32)
+        derived = numpy.zeros(len(rows), dtype=bool)
+        derived[known] = self.validation_data.is_derived(rows[known], periods[known])
+        if derived.any():
+            # Derived averages are not rounded like the claim is, so they match up to its rounding.
+            equal |= derived & (numpy.abs(cells - claimed[owners]) <= tolerances[owners])
+        # Claims worded as a change or an average are also checked against that derived series.
+        in_series = numpy.zeros(len(rows), dtype=bool)
+        for name, series in self.validation_data.series.items():
+            wanted = known & numpy.array([claim.series == name for claim in claims], dtype=bool)[owners]
+            if wanted.any():
+                series_cells = series.lookup(rows[wanted], periods[wanted])
+                in_series[wanted] = numpy.abs(series_cells - claimed[owners][wanted]) <= tolerances[owners][wanted]
+        in_series &= ~equal
+        matches = numpy.flatnonzero(equal | in_series)
+
+        result_rows = numpy.full(count, -1, dtype=numpy.int64)
+        checked = (lengths > 0) & (period_ids >= 0)
+        # The last candidate of each claim with a cell for its period; the first in reverse order.
+        with_cell = numpy.flatnonzero(~numpy.isnan(cells))[::-1]
+        claims_with_cell, last_cells = numpy.unique(owners[with_cell], return_index=True)
+        result_rows[claims_with_cell] = rows[with_cell[last_cells]]
+        has_cell = numpy.zeros(count, dtype=bool)
+        has_cell[claims_with_cell] = True
+        is_valid = numpy.zeros(count, dtype=bool)
+        matched_claims, first_matches = numpy.unique(owners[matches], return_index=True)
+        is_valid[matched_claims] = True
+        result_rows[matched_claims] = rows[matches[first_matches]]
+
+        reasons = [
+            None if valid else ("INVALID_METRIC" if usable else "INSUFFICIENT_DATA")
+            for valid, usable in zip(is_valid.tolist(), has_cell.tolist())
+        ]
+        periods = [claim.period if usable else None for claim, usable in zip(claims, checked.tolist())]
+        series = [None] * count
+        for index, match in zip(matched_claims.tolist(), matches[first_matches].tolist()):
+            if in_series[match]:
+                series[index] = claims[index].series
+        for index, claim in enumerate(claims):
+            if claim.missing and claim.rows and period_ids[index] < 0:
+                found = self.find_period(claim, claimed[index])
+                if found is None:
+                    result_rows[index], periods[index], reasons[index] = -1, None, claim.missing
+                    continue
+                result_rows[index], periods[index], exact = found
+                # Among a row's hundreds of periods some cell is almost always close to the claimed
+                # value, so the period found is reported without confirming the claim.
+                is_valid[index] = exact and ACCEPT_INFERRED_PERIODS
+                reasons[index] = None if is_valid[index] else "PERIOD_INFERRED"
+        return ValidationResult(
+            is_valid=is_valid, rows=result_rows, periods=periods, series=series, reasons=reasons
+        )
+
+    def find_period(self, claim: Claim, value: float):
+        """
+        (row, period, exact) of the first candidate row with a cell close to the claimed value, or
+        None; `exact` tells whether the cell equals the value in float32.
+        """
+        if numpy.isnan(value):
+            return None
+        allowed = None
+        if claim.allowed_periods is not None:
+            period_index = self.validation_data.period_index
+            allowed = [period_index[period] for period in claim.allowed_periods if period in period_index]
+        tolerance = rounding_tolerance(claim.value)
+        for row in claim.rows:
+            period_ids, values = self.validation_data.value_index.periods_near(row, value, tolerance)
+            if allowed is not None:
+                keep = numpy.isin(period_ids, allowed)
+                period_ids, values = period_ids[keep], values[keep]
+            if len(period_ids):
+                # The closest value wins, then the later period.
+                best = numpy.lexsort((-period_ids, numpy.abs(values - value)))[0]
+                return row, self.validation_data.periods[period_ids[best]], bool(values[best] == value)
+        return None